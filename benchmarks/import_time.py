@@ -0,0 +1,57 @@
+"""Measure how long `import iron_core` takes in a fresh interpreter.
+
+Each sample starts a new Python process, so module caches are cold the way
+they are for a short-lived worker or CLI tool. The heavy dependencies that
+iron_core loads lazily are timed separately for comparison.
+
+    python benchmarks/import_time.py [--samples N]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+SCRIPT = """
+import sys, time
+started = time.time()
+import %s
+elapsed = time.time() - started
+print("%%f %%d %%d" %% (elapsed, "requests" in sys.modules,
+                       "dateutil" in sys.modules))
+"""
+
+
+def measure(modules, samples):
+    times = []
+    for i in range(samples):
+        out = subprocess.check_output([sys.executable, "-c", SCRIPT % modules],
+                                      cwd=ROOT)
+        elapsed, requests, dateutil = out.decode("ascii").split()
+        times.append(float(elapsed))
+    times.sort()
+    return times[len(times) // 2], times[0], requests == "1", dateutil == "1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--samples", type=int, default=20,
+                        help="fresh interpreters started per case")
+    args = parser.parse_args()
+
+    cases = [
+        ("iron_core", "iron_core"),
+        ("requests", "requests"),
+        ("dateutil.parser", "dateutil.parser"),
+        ("iron_core+deps", "iron_core, requests, dateutil.parser"),
+    ]
+    for name, modules in cases:
+        median, best, requests, dateutil = measure(modules, args.samples)
+        print("%-16s median %7.2f ms  best %7.2f ms  requests %-5s "
+              "dateutil %s" % (name, median * 1000, best * 1000, requests,
+                               dateutil))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""A local stand-in for the Iron.io HTTP APIs, for benchmarking IronClient.
+
+It answers the common IronMQ (v3), IronWorker (v2) and IronCache (v1)
+calls plus the Keystone `tokens` endpoint with canned JSON, and can add
+latency and bursts of 503 responses to the Iron API calls. It counts requests and accepted
+connections so connection reuse can be measured.
+
+    python benchmarks/mock_iron.py --port 8080 --latency 0.005
+"""
+import argparse
+import json
+import re
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+ROUTES = []
+
+
+def route(method, pattern):
+    def register(func):
+        ROUTES.append((method, re.compile(pattern + "$"), func))
+        return func
+    return register
+
+
+@route("POST", r"/3/projects/[^/]+/queues/([^/]+)/messages")
+def mqPost(server, match, body):
+    messages = json.loads(body.decode("utf-8") or "{}").get("messages", [])
+    ids = [str(server.nextId()) for message in messages]
+    return {"ids": ids, "msg": "Messages put on queue."}
+
+
+@route("POST", r"/3/projects/[^/]+/queues/([^/]+)/reservations")
+def mqReserve(server, match, body):
+    n = json.loads(body.decode("utf-8") or "{}").get("n", 1)
+    return {"messages": [{"id": str(server.nextId()), "body": "hello",
+                          "reserved_count": 1,
+                          "reservation_id": "r%d" % i} for i in range(n)]}
+
+
+@route("GET", r"/3/projects/[^/]+/queues/([^/]+)")
+def mqInfo(server, match, body):
+    return {"queue": {"name": match.group(1), "size": 10,
+                      "total_messages": 100}}
+
+
+@route("DELETE", r"/3/projects/[^/]+/queues/([^/]+)/messages/([^/]+)")
+def mqDelete(server, match, body):
+    return {"msg": "Deleted"}
+
+
+@route("POST", r"/2/projects/[^/]+/tasks")
+def workerQueue(server, match, body):
+    tasks = json.loads(body.decode("utf-8") or "{}").get("tasks", [])
+    return {"tasks": [{"id": str(server.nextId())} for task in tasks],
+            "msg": "Queued up"}
+
+
+@route("GET", r"/2/projects/[^/]+/tasks/([^/]+)")
+def workerTask(server, match, body):
+    return {"id": match.group(1), "code_name": "bench", "status": "complete",
+            "duration": 1000}
+
+
+@route("GET", r"/1/projects/[^/]+/caches/([^/]+)/items/([^/]+)")
+def cacheGet(server, match, body):
+    return {"cache": match.group(1), "key": match.group(2), "value": "x" * 64}
+
+
+@route("PUT", r"/1/projects/[^/]+/caches/([^/]+)/items/([^/]+)")
+def cachePut(server, match, body):
+    return {"msg": "Stored."}
+
+
+@route("POST", r"(?:/v2.0)?/tokens")
+def keystoneTokens(server, match, body):
+    server.keystone_requests += 1
+    return {"access": {"token": {
+        "id": "bench-token-%d" % server.keystone_requests,
+        "issued_at": "2014-01-01T10:00:00.000000Z",
+        "expires": "2014-01-01T11:00:00Z"}}}
+
+
+class MockIronHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without TCP_NODELAY every
+    # response stalls on delayed ACKs.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def _respond(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+                if not size:
+                    break
+        else:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            count = server.requests
+        if server.latency:
+            time.sleep(server.latency)
+
+        path = self.path.split("?")[0]
+        keystone = path.endswith("/tokens")
+        if server.burst_every and not keystone and \
+                count % server.burst_every < server.burst_length:
+            status, payload = 503, {"msg": "Service Unavailable"}
+        else:
+            status, payload = 404, {"msg": "Not Found"}
+            for method, pattern, func in ROUTES:
+                match = pattern.match(path)
+                if match and method == self.command:
+                    status, payload = 200, func(server, match, body)
+                    break
+
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if status == 503:
+            self.send_header("Retry-After", "0")
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_PATCH = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+class MockIronServer(ThreadingMixIn, HTTPServer):
+    """A threaded mock Iron API server running in a background thread.
+
+    Keyword arguments:
+    port -- The port to listen on. Defaults to 0 (any free port).
+    latency -- Seconds to wait before answering each request. Defaults to 0.
+    burst_every -- Answer burst_length requests out of every burst_every
+                   with 503 Service Unavailable. Defaults to 0 (never).
+    burst_length -- The length of each 503 burst. Defaults to 1.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    # The default backlog of 5 drops SYNs under concurrent connects, and the
+    # 1s retransmits would show up as client latency.
+    request_queue_size = 128
+
+    def __init__(self, port=0, latency=0, burst_every=0, burst_length=1):
+        HTTPServer.__init__(self, ("127.0.0.1", port), MockIronHandler)
+        self.latency = latency
+        self.burst_every = burst_every
+        self.burst_length = burst_length
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.keystone_requests = 0
+        self._id = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def nextId(self):
+        with self.lock:
+            self._id += 1
+            return self._id
+
+    def resetCounters(self):
+        with self.lock:
+            self.connections = 0
+            self.requests = 0
+            self.keystone_requests = 0
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--burst-every", type=int, default=0)
+    parser.add_argument("--burst-length", type=int, default=1)
+    args = parser.parse_args()
+    server = MockIronServer(args.port, args.latency, args.burst_every,
+                            args.burst_length)
+    print("Mock Iron API listening on http://127.0.0.1:%d" % server.port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
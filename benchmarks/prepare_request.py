@@ -0,0 +1,71 @@
+"""Microbenchmark for the per-call header and URL preparation in IronClient.
+
+Compares the prepared fast path (IronClient._prepareRequest and
+IronClient._authorize) against the header merging and URL building that
+IronClient.request used to do on every call. Nothing is sent over the
+network.
+
+    python benchmarks/prepare_request.py [--number N]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import iron_core
+
+
+def legacyPrepare(client, defaults, url, headers, token):
+    if headers:
+        headers = dict(list(headers.items()) + list(defaults.items()))
+    else:
+        headers = defaults
+
+    if not sys.version_info >= (3,) and headers:
+        headers = dict((k.encode('ascii') if isinstance(k, unicode) else k,
+                        v.encode('ascii') if isinstance(v, unicode) else v)
+                       for k, v in headers.items())
+
+    url = client.base_url + url
+    if not sys.version_info >= (3,):
+        if isinstance(url, unicode):
+            url = url.encode('ascii')
+    headers["Authorization"] = "OAuth %s" % token
+    return url, headers
+
+
+def preparedPrepare(client, defaults, url, headers, token):
+    url, headers = client._prepareRequest(url, headers)
+    return url, client._authorize(headers, token)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--number", type=int, default=200000,
+                        help="calls per measurement")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="measurements per case, the best is reported")
+    args = parser.parse_args()
+
+    client = iron_core.IronClient(name="bench", version="0.1.0",
+            product="iron_mq", token="TOKEN", project_id="PROJECT")
+    defaults = dict(client.headers)
+    cases = [
+        ("default headers", "queues/my_queue/messages", {}),
+        ("extra headers", "queues/my_queue/messages",
+         {"Content-Type": "application/json"}),
+    ]
+    for name, url, headers in cases:
+        for label, prepare in (("legacy", legacyPrepare),
+                               ("prepared", preparedPrepare)):
+            timer = timeit.Timer(lambda: prepare(client, defaults, url,
+                                                 headers, "TOKEN"))
+            best = min(timer.repeat(args.repeat, args.number))
+            print("%-16s %-9s %7.3f us/call" % (name, label,
+                                                best / args.number * 1e6))
+
+
+if __name__ == "__main__":
+    main()
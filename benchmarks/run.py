@@ -0,0 +1,371 @@
+"""Benchmark IronClient against the local mock Iron API server.
+
+Runs each scenario against benchmarks/mock_iron.py and reports throughput,
+p50/p99 latency, memory allocated while running a sample of the calls,
+and the number of connections the server accepted. The latency of the
+request_many scenario is that of each fixed-size batch. Results can be
+written as JSON so runs can be compared to catch regressions.
+
+    python benchmarks/run.py --ops 2000 --threads 4 --output bench.json
+    python benchmarks/run.py --scenario mq_get --latency 0.002
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import iron_core
+from mock_iron import MockIronServer
+
+try:
+    import asyncio
+    import iron_core_async
+except ImportError:
+    iron_core_async = None
+
+try:
+    perf_counter = time.perf_counter
+except AttributeError:
+    perf_counter = time.time
+
+
+def makeClient(server, product="iron_mq", cls=iron_core.IronClient,
+               **kwargs):
+    versions = {"iron_mq": 3, "iron_worker": 2, "iron_cache": 1}
+    kwargs.setdefault("token", "BENCH")
+    kwargs.setdefault("retry_policy", iron_core.RetryPolicy(backoff=.001))
+    return cls(name="bench", version="0.1.0", product=product,
+               project_id="bench", protocol="http", host="127.0.0.1",
+               port=server.port, api_version=versions[product], **kwargs)
+
+
+def mqPost(client, i):
+    client.post("queues/bench/messages",
+                body={"messages": [{"body": "message %d" % i}]})
+
+
+def mqGet(client, i):
+    client.get("queues/bench")
+
+
+def mqDelete(client, i):
+    client.delete("queues/bench/messages/%d" % i)
+
+
+def workerTask(client, i):
+    client.get("tasks/%d" % i)
+
+
+def cachePut(client, i):
+    client.put("caches/bench/items/key%d" % i, body={"value": "x" * 64})
+
+
+def cacheGet(client, i):
+    client.get("caches/bench/items/key%d" % i)
+
+
+SYNC_SCENARIOS = {
+    "mq_post": ("iron_mq", mqPost),
+    "mq_get": ("iron_mq", mqGet),
+    "mq_delete": ("iron_mq", mqDelete),
+    "worker_task": ("iron_worker", workerTask),
+    "cache_put": ("iron_cache", cachePut),
+    "cache_get": ("iron_cache", cacheGet),
+}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(name, server, latencies, elapsed, ops, extra=None):
+    result = {
+        "scenario": name,
+        "ops": ops,
+        "seconds": round(elapsed, 4),
+        "ops_per_sec": round(ops / elapsed, 1) if elapsed else None,
+        "p50_ms": None,
+        "p99_ms": None,
+        "connections": server.connections,
+        "server_requests": server.requests,
+    }
+    if latencies:
+        result["p50_ms"] = round(percentile(latencies, .5) * 1000, 3)
+        result["p99_ms"] = round(percentile(latencies, .99) * 1000, 3)
+    result.update(extra or {})
+    return result
+
+
+def startTracing():
+    """Start tracing allocations and return the snapshot to compare with."""
+    tracemalloc.start()
+    return tracemalloc.take_snapshot()
+
+
+def stopTracing(before, calls):
+    """Stop tracing allocations and return the peak traced memory and the
+    number of blocks allocated per call over the calls made since
+    startTracing returned before."""
+    try:
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "lineno")
+                 if stat.count_diff > 0)
+    return {"alloc_peak_kb": round(peak / 1024.0, 1),
+            "alloc_blocks_per_op": round(blocks / float(calls), 1)}
+
+
+def measureAllocations(run, calls):
+    """Return the allocations of run(), which makes calls calls."""
+    before = startTracing()
+    try:
+        run()
+    except BaseException:
+        tracemalloc.stop()
+        raise
+    return stopTracing(before, calls)
+
+
+def runSync(name, server, args, **client_kwargs):
+    product, op = SYNC_SCENARIOS[name]
+    client = makeClient(server, product, **client_kwargs)
+    op(client, 0)
+    allocations = measureAllocations(
+            lambda: [op(client, i) for i in range(args.alloc_sample)],
+            args.alloc_sample)
+    client.close()
+
+    server.resetCounters()
+    client = makeClient(server, product, **client_kwargs)
+    latencies = []
+    per_thread = args.ops // args.threads
+
+    def worker(offset):
+        mine = []
+        for i in range(offset, offset + per_thread):
+            started = perf_counter()
+            op(client, i)
+            mine.append(perf_counter() - started)
+        latencies.extend(mine)
+
+    threads = [threading.Thread(target=worker, args=(n * per_thread,))
+               for n in range(args.threads)]
+    started = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - started
+    extra = dict(allocations, threads=args.threads,
+                 retries=client.retry_policy.retries)
+    client.close()
+    return summarize(name, server, latencies, elapsed,
+                     per_thread * args.threads, extra)
+
+
+def runBatch(server, args):
+    client = makeClient(server, "iron_worker", pool_maxsize=args.concurrency)
+    specs = [("GET", "tasks/%d" % i) for i in range(args.ops)]
+    batch_size = args.batch_size
+    client.request_many(specs[:batch_size], max_concurrency=args.concurrency)
+    sample = specs[:args.alloc_sample]
+    allocations = measureAllocations(
+            lambda: client.request_many(sample,
+                                        max_concurrency=args.concurrency),
+            len(sample))
+    client.close()
+
+    server.resetCounters()
+    client = makeClient(server, "iron_worker", pool_maxsize=args.concurrency)
+    latencies = []
+    errors = 0
+    started = perf_counter()
+    for i in range(0, len(specs), batch_size):
+        t = perf_counter()
+        results = client.request_many(specs[i:i + batch_size],
+                                      max_concurrency=args.concurrency)
+        latencies.append(perf_counter() - t)
+        errors += sum(1 for r in results if isinstance(r, Exception))
+    elapsed = perf_counter() - started
+    extra = dict(allocations, concurrency=args.concurrency,
+                 batch_size=batch_size, errors=errors,
+                 retries=client.retry_policy.retries)
+    client.close()
+    return summarize("batch_worker_task", server, latencies, elapsed,
+                     args.ops, extra)
+
+
+def runBatched(server, args):
+    server.resetCounters()
+    client = makeClient(server, "iron_mq")
+    batcher = iron_core.AutoBatcher(client, max_delay=args.batch_delay)
+    latencies = []
+    per_thread = args.ops // args.threads
+
+    def worker(offset):
+        pending = []
+        for i in range(offset, offset + per_thread):
+            future = batcher.submit("queues/bench/messages",
+                                    {"body": "message %d" % i})
+            pending.append((perf_counter(), future))
+        mine = []
+        for submitted, future in pending:
+            future.result()
+            mine.append(perf_counter() - submitted)
+        latencies.extend(mine)
+
+    threads = [threading.Thread(target=worker, args=(n * per_thread,))
+               for n in range(args.threads)]
+    started = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - started
+    batcher.close()
+    client.close()
+    return summarize("mq_post_batched", server, latencies, elapsed,
+                     per_thread * args.threads,
+                     {"threads": args.threads, "batches": batcher.batches})
+
+
+def runAsync(server, args):
+    def makeAsyncClient():
+        return makeClient(server, "iron_worker",
+                          cls=iron_core_async.AsyncIronClient,
+                          pool_maxsize=args.concurrency)
+
+    async def gatherGets(client, ops, latencies):
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def one(i):
+            async with semaphore:
+                started = perf_counter()
+                await client.get("tasks/%d" % i)
+                latencies.append(perf_counter() - started)
+        await asyncio.gather(*[one(i) for i in range(ops)])
+
+    async def allocations():
+        client = makeAsyncClient()
+        await client.get("tasks/0")
+        before = startTracing()
+        try:
+            await gatherGets(client, args.alloc_sample, [])
+        except BaseException:
+            tracemalloc.stop()
+            raise
+        result = stopTracing(before, args.alloc_sample)
+        await client.close()
+        return result
+
+    async def run():
+        client = makeAsyncClient()
+        started = perf_counter()
+        await gatherGets(client, args.ops, latencies)
+        elapsed = perf_counter() - started
+        await client.close()
+        return elapsed
+
+    latencies = []
+    loop = asyncio.new_event_loop()
+    try:
+        extra = loop.run_until_complete(allocations())
+        server.resetCounters()
+        elapsed = loop.run_until_complete(run())
+    finally:
+        loop.close()
+    extra["concurrency"] = args.concurrency
+    return summarize("async_worker_task", server, latencies, elapsed,
+                     args.ops, extra)
+
+
+def runKeystone(server, args):
+    server.resetCounters()
+    keystone = {"server": "http://127.0.0.1:%d/v2.0" % server.port,
+                "tenant": "bench", "username": "bench", "password": "bench"}
+    client = makeClient(server, "iron_mq", token=None, keystone=keystone)
+    latencies = []
+    started = perf_counter()
+    for i in range(args.ops):
+        t = perf_counter()
+        mqGet(client, i)
+        latencies.append(perf_counter() - t)
+    elapsed = perf_counter() - started
+    client.close()
+    return summarize("keystone_mq_get", server, latencies, elapsed, args.ops,
+                     {"keystone_requests": server.keystone_requests})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--ops", type=int, default=1000,
+                        help="calls per scenario")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="threads sharing one client in sync scenarios")
+    parser.add_argument("--concurrency", type=int, default=16,
+                        help="in-flight calls for batch and async scenarios")
+    parser.add_argument("--batch-size", type=int, default=64,
+                        help="calls per request_many batch")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds the mock server waits per request")
+    parser.add_argument("--burst-every", type=int, default=0,
+                        help="answer with 503 bursts every N requests")
+    parser.add_argument("--burst-length", type=int, default=1)
+    parser.add_argument("--batch-delay", type=float, default=.005,
+                        help="seconds an auto-batched message may wait")
+    parser.add_argument("--alloc-sample", type=int, default=100,
+                        help="calls traced to measure allocations")
+    parser.add_argument("--scenario", action="append",
+                        help="run only this scenario (repeatable)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    server = MockIronServer(latency=args.latency,
+                            burst_every=args.burst_every,
+                            burst_length=args.burst_length)
+    runners = [(name, lambda name=name: runSync(name, server, args))
+               for name in sorted(SYNC_SCENARIOS)]
+    runners.append(("batch_worker_task", lambda: runBatch(server, args)))
+    runners.append(("mq_post_batched", lambda: runBatched(server, args)))
+    if iron_core_async is not None:
+        runners.append(("async_worker_task", lambda: runAsync(server, args)))
+    runners.append(("keystone_mq_get", lambda: runKeystone(server, args)))
+
+    results = []
+    try:
+        for name, runner in runners:
+            if args.scenario and name not in args.scenario:
+                continue
+            result = runner()
+            results.append(result)
+            print("%-20s %9s ops/s  p50 %8s ms  p99 %8s ms  conns %d" % (
+                name, result["ops_per_sec"], result["p50_ms"],
+                result["p99_ms"], result["connections"]))
+    finally:
+        server.stop()
+
+    if args.output:
+        report = {
+            "python": platform.python_version(),
+            "iron_core": iron_core.IronClient.__version__,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "options": vars(args),
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
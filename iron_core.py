@@ -1,9 +1,24 @@
 import time
-from datetime import datetime
+from datetime import datetime, timedelta, tzinfo
 import os
 import sys
-import dateutil.parser
-import requests
+import threading
+import random
+import hashlib
+import contextlib
+import codecs
+import types
+import weakref
+import re
+import fnmatch
+import zlib
+import errno
+import socket
+from collections import deque, OrderedDict
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 try:
     from urlparse import urlparse
 except:
@@ -14,6 +29,69 @@ try:
 except:
     import simplejson as json
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    monotonic = time.time
+
+# Objects holding locks, connections or threads that must be reset in the
+# child after os.fork(); see afterFork.
+_fork_safe = weakref.WeakSet()
+_pid = os.getpid()
+
+
+def forkSafe(obj):
+    """Register obj to be reset by afterFork in forked children and return
+    it. Its _afterFork() method is called, or if it has none, its _lock is
+    replaced with a new lock."""
+    _fork_safe.add(obj)
+    return obj
+
+
+def afterFork():
+    """Reset the state a forked child cannot inherit: locks that another
+    thread of the parent may have held, pooled connections shared with the
+    parent, and background threads that do not exist in the child. Runs
+    automatically in the child on Pythons with os.register_at_fork, and on
+    the first request in the child on older ones."""
+    global _pid, _config_lock
+    _pid = os.getpid()
+    _config_lock = threading.Lock()
+    for obj in list(_fork_safe):
+        reset = getattr(obj, "_afterFork", None)
+        if reset is not None:
+            reset()
+        else:
+            obj._lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=afterFork)
+    checkFork = None
+else:
+    def checkFork():
+        if os.getpid() != _pid:
+            afterFork()
+
+# requests and dateutil are slow to import and not needed until a client
+# sends its first request or meets an unusual timestamp; see loadRequests
+# and parseRfc3339.
+requests = None
+dateutil = None
+
+
+def loadRequests():
+    """Import and return the requests module."""
+    global requests
+    if requests is None:
+        import requests.adapters
+    return requests
+
 
 class IronTokenProvider(object):
     def __init__(self, token):
@@ -24,60 +102,1442 @@ class IronTokenProvider(object):
 
 
 class KeystoneTokenProvider(object):
-    def __init__(self, keystone):
+    """Fetch and cache OAuth tokens from a Keystone server.
+
+    Safe to share between threads: only one thread refreshes an expiring
+    token while the others keep using the current one, and a refresh is
+    started in the background refresh_margin seconds before expiry so
+    callers rarely wait on Keystone at all.
+
+    If the keystone config has a "cache_file" entry, tokens are also kept in
+    that file, readable only by its owner and locked while in use, so every
+    process on a host with the same server, tenant and username shares one
+    token instead of each authenticating separately.
+    """
+
+    # Seconds before expiry at which a token is no longer handed out.
+    expiry_margin = 10
+    # Seconds before expiry at which a background refresh is started.
+    refresh_margin = 60
+    # Seconds to wait for Keystone to accept a connection and to send data,
+    # where no timeout is given.
+    default_timeout = (10, 30)
+
+    def __init__(self, keystone, timeout=None):
+        """Create a token provider.
+
+        Keyword arguments:
+        keystone -- The keystone config: server, tenant, username, password
+                    and optionally cache_file. Required.
+        timeout -- A (connect, read) tuple of seconds to wait for Keystone.
+                   None, or None in either position, uses default_timeout.
+        """
         self.server = keystone["server"] + ("" if keystone["server"].endswith("/") else "/")
         self.tenant = keystone["tenant"]
         self.username = keystone["username"]
         self.password = keystone["password"]
+        self.cache_file = keystone.get("cache_file")
+        if self.cache_file is not None:
+            self.cache_file = os.path.expanduser(self.cache_file)
+        connect, read = timeout or (None, None)
+        self.timeout = (
+                self.default_timeout[0] if connect is None else connect,
+                self.default_timeout[1] if read is None else read)
+        # The process holding the cache file gives up on Keystone within
+        # about this long, so waiting longer for it means it is stuck.
+        self.lock_timeout = self.timeout[0] + self.timeout[1]
         self.token = None
-        self.local_expires_at_timestamp = 0
+        self.local_expires_at = 0
+        self.duration = 0
+        self._lock = threading.Lock()
+        self._flag_lock = threading.Lock()
+        self._refreshing = False
+        # Called with the new token's duration and the time the refresh took.
+        self.listeners = []
+        forkSafe(self)
 
+    def _afterFork(self):
+        # The token is still valid in the child, but a refresh the parent
+        # had in flight is not.
+        self._lock = threading.Lock()
+        self._flag_lock = threading.Lock()
+        self._refreshing = False
 
     def getToken(self):
-        date_diff = time.mktime(datetime.now().timetuple()) - self.local_expires_at_timestamp
-        if self.token is None or date_diff > -10:
-            payload = {
-                'auth': {
-                    'tenantName': self.tenant,
-                    'passwordCredentials': {
-                        'username': self.username,
-                        'password': self.password
-                    }
+        now = monotonic()
+        token = self.token
+        if token is not None and now < self.local_expires_at - self.expiry_margin:
+            if self._shouldRefresh(now):
+                self._refreshInBackground()
+            return token
+
+        with self._lock:
+            if self.token is None or \
+                    monotonic() >= self.local_expires_at - self.expiry_margin:
+                self._refresh()
+            return self.token
+
+    def _shouldRefresh(self, now):
+        return now >= self.local_expires_at - min(self.refresh_margin,
+                                                  self.duration / 2.0)
+
+    def _refreshInBackground(self):
+        with self._flag_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        thread = threading.Thread(target=self._backgroundRefresh)
+        thread.daemon = True
+        thread.start()
+
+    def _backgroundRefresh(self):
+        try:
+            with self._lock:
+                # A foreground refresh may have beaten us to it.
+                if self._shouldRefresh(monotonic()):
+                    self._refresh()
+        except Exception:
+            # The next getToken() past expiry_margin refreshes in the
+            # foreground and surfaces the error to its caller.
+            pass
+        finally:
+            with self._flag_lock:
+                self._refreshing = False
+
+    def _refresh(self):
+        """Fetch a new token. Must be called with _lock held."""
+        started = monotonic()
+        if self.cache_file is None:
+            token, duration = self._fetchToken()
+            expires_in = duration
+        else:
+            token, duration, expires_in = self._fetchCachedToken()
+        self.duration = duration
+        self.local_expires_at = monotonic() + expires_in
+        self.token = token
+        for listener in self.listeners:
+            listener(duration, monotonic() - started)
+
+    def _fetchCachedToken(self):
+        """Return a token, its lifetime and the seconds left until it expires,
+        reusing the one in cache_file when it is not due for a refresh. The
+        file stays locked while Keystone is asked for a new token so other
+        processes wait for it instead of fetching their own. If the file
+        stays locked for lock_timeout, a token is fetched without it."""
+        key = hashlib.sha1(("%s|%s|%s" % (self.server, self.tenant,
+                self.username)).encode("utf-8")).hexdigest()
+        with lockedFile(self.cache_file, self.lock_timeout) as fd:
+            if fd is None:
+                token, duration = self._fetchToken()
+                return token, duration, duration
+            try:
+                cache = json.loads(readFile(fd).decode("utf-8"))
+                if not isinstance(cache, dict):
+                    cache = {}
+            except ValueError:
+                cache = {}
+
+            now = time.time()
+            entry = cache.get(key)
+            if entry is not None:
+                expires_in = entry["expires_at"] - now
+                if expires_in > min(self.refresh_margin,
+                                    entry["duration"] / 2.0):
+                    return entry["id"], entry["duration"], expires_in
+
+            token, duration = self._fetchToken()
+            cache[key] = {"id": token, "duration": duration,
+                          "expires_at": now + duration}
+            for k in list(cache.keys()):
+                if cache[k]["expires_at"] < now:
+                    del cache[k]
+            writeFile(fd, json.dumps(cache).encode("utf-8"))
+            return token, duration, duration
+
+    def _fetchToken(self):
+        """Authenticate against Keystone and return the new token id and its
+        lifetime in seconds."""
+        payload = {
+            'auth': {
+                'tenantName': self.tenant,
+                'passwordCredentials': {
+                    'username': self.username,
+                    'password': self.password
                 }
             }
+        }
 
-            headers = {'content-type': 'application/json', 'Accept': 'application/json'}
+        headers = {'content-type': 'application/json', 'Accept': 'application/json'}
 
-            response = requests.post(self.server + 'tokens', data=json.dumps(payload), headers=headers)
-            response.raise_for_status()
+        response = loadRequests().post(self.server + 'tokens', data=json.dumps(payload), headers=headers,
+                                       timeout=self.timeout)
+        response.raise_for_status()
 
-            result = response.json()
-            token_data = result['access']['token']
+        result = response.json()
+        token_data = result['access']['token']
 
-            issued_at = dateutil.parser.parse(token_data['issued_at']).replace(tzinfo=None)
-            expires = dateutil.parser.parse(token_data['expires']).replace(tzinfo=None)
-            duration = expires - issued_at
+        issued_at = parseRfc3339(token_data['issued_at']).replace(tzinfo=None)
+        expires = parseRfc3339(token_data['expires']).replace(tzinfo=None)
+        duration = expires - issued_at
 
-            self.local_expires_at_timestamp = time.mktime((datetime.now() + duration).timetuple())
-            self.token = token_data['id']
+        return token_data['id'], duration.days * 86400 + duration.seconds
 
-        return self.token
+
+class JsonCodec(object):
+    """Encode and decode JSON with the standard library json module.
+    Subclasses wrap faster implementations; any object with the same loads
+    and dumps methods may be given to IronClient as its json_codec."""
+
+    name = "json"
+
+    def loads(self, data):
+        """Parse a JSON document from bytes or text."""
+        if isinstance(data, bytes) and not isinstance(data, str):
+            data = data.decode("utf-8")
+        return json.loads(data)
+
+    def dumps(self, obj):
+        """Serialize obj to UTF-8 encoded JSON bytes."""
+        return json.dumps(obj).encode("utf-8")
+
+
+class OrjsonCodec(JsonCodec):
+    """Encode and decode JSON with orjson."""
+
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self.loads = orjson.loads
+        self.dumps = orjson.dumps
+
+
+class UjsonCodec(JsonCodec):
+    """Encode and decode JSON with ujson."""
+
+    name = "ujson"
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+        self.loads = ujson.loads
+
+    def dumps(self, obj):
+        return self._ujson.dumps(obj).encode("utf-8")
+
+
+json_codecs = {
+    "json": JsonCodec,
+    "orjson": OrjsonCodec,
+    "ujson": UjsonCodec,
+}
+
+_default_json_codec = None
+
+
+def findJsonCodec(name=None):
+    """Return the JSON codec called name, or when name is None the fastest
+    one installed, preferring orjson, then ujson, then the standard
+    library."""
+    global _default_json_codec
+    if name is not None:
+        if name not in json_codecs:
+            raise ValueError("Unknown JSON codec: %s" % name)
+        return json_codecs[name]()
+    if _default_json_codec is None:
+        for codec in (OrjsonCodec, UjsonCodec, JsonCodec):
+            try:
+                _default_json_codec = codec()
+                break
+            except ImportError:
+                pass
+    return _default_json_codec
+
+
+def requestsSession(client):
+    """The default transport: a requests.Session keeping a pool of HTTP/1.1
+    keep-alive connections per host, sized by the client's pool settings.
+
+    A transport is created by calling its factory with the IronClient
+    whose requests it sends. It needs a request(method, url, data,
+    headers, timeout, stream) method returning a requests.Response, or an
+    object with the same interface, and a close() method. Connection
+    problems must be raised as requests.exceptions.ConnectionError and
+    timeouts as requests.exceptions.Timeout.
+    """
+    requests = loadRequests()
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+            pool_connections=client.pool_connections,
+            pool_maxsize=client.pool_maxsize,
+            pool_block=client.pool_block)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def loadHttpx():
+    """Import and return the httpx module the http2 transport needs."""
+    try:
+        import httpx
+    except ImportError:
+        raise ImportError("The http2 transport requires httpx; install "
+                          "iron_core with the http2 extra")
+    return httpx
+
+
+class Http2Transport(object):
+    """A transport that multiplexes concurrent requests to a host over a
+    single HTTP/2 connection, using httpx. HTTPS hosts negotiate HTTP/2
+    and fall back to HTTP/1.1 when the server does not support it; plain
+    HTTP is spoken as HTTP/1.1 unless http1 is False, which assumes the
+    server speaks HTTP/2 without TLS.
+    """
+
+    def __init__(self, client, http1=True):
+        httpx = self._httpx = loadHttpx()
+        self.client = httpx.Client(http1=http1, http2=True,
+                limits=httpx.Limits(
+                    max_connections=client.pool_connections *
+                                    client.pool_maxsize,
+                    max_keepalive_connections=client.pool_connections))
+
+    def request(self, method, url, data=None, headers=None, timeout=None,
+                stream=False):
+        httpx = self._httpx
+        if timeout is None:
+            timeout = httpx.Timeout(None)
+        else:
+            timeout = httpx.Timeout(None, connect=timeout[0],
+                                    read=timeout[1])
+        if isinstance(data, (bytearray, memoryview)):
+            # httpx would iterate these as ints.
+            data = bytes(data)
+        elif data is not None and not isinstance(data, bytes) and \
+                hasattr(data, "read"):
+            data = iterFile(data, 65536)
+        started = monotonic()
+        with httpxErrors():
+            request = self.client.build_request(method, url, content=data,
+                    headers=headers, timeout=timeout)
+            resp = self.client.send(request, stream=stream)
+        return Http2Response(resp, monotonic() - started)
+
+    def close(self):
+        self.client.close()
+
+
+class Http2Response(object):
+    """Presents an httpx response with the parts of the requests.Response
+    interface IronClient and its callers use."""
+
+    request = None
+
+    def __init__(self, resp, elapsed):
+        self.raw = resp
+        self.status_code = resp.status_code
+        self.headers = resp.headers
+        self.url = str(resp.url)
+        self.reason = resp.reason_phrase
+        self.http_version = resp.http_version
+        # Like requests, the time until the response headers arrived.
+        self.elapsed = timedelta(seconds=elapsed)
+
+    @property
+    def content(self):
+        with httpxErrors():
+            return self.raw.read()
+
+    @property
+    def text(self):
+        with httpxErrors():
+            self.raw.read()
+        return self.raw.text
+
+    @property
+    def encoding(self):
+        return self.raw.encoding
+
+    def json(self, **kwargs):
+        return json.loads(self.text, **kwargs)
+
+    def iter_content(self, chunk_size=1):
+        chunks = self.raw.iter_bytes(chunk_size)
+        while True:
+            with httpxErrors():
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    def iter_lines(self, chunk_size=512):
+        pending = None
+        for chunk in self.iter_content(chunk_size):
+            if pending is not None:
+                chunk = pending + chunk
+            lines = chunk.splitlines()
+            if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1]:
+                pending = lines.pop()
+            else:
+                pending = None
+            for line in lines:
+                yield line
+        if pending is not None:
+            yield pending
+
+    def close(self):
+        self.raw.close()
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 600:
+            kind = "Client" if self.status_code < 500 else "Server"
+            raise loadRequests().exceptions.HTTPError(
+                    "%s %s Error: %s for url: %s" % (self.status_code, kind,
+                                                     self.reason, self.url),
+                    response=self)
+
+
+@contextlib.contextmanager
+def httpxErrors():
+    """Raise httpx's transport errors as the requests exceptions IronClient
+    and its callers handle: timeouts as Timeout, failed and broken
+    connections as ConnectionError, and the rest as the closest
+    RequestException."""
+    import httpx
+    exceptions = loadRequests().exceptions
+    try:
+        yield
+    except httpx.TimeoutException as e:
+        raise exceptions.Timeout(e)
+    except httpx.ProxyError as e:
+        raise exceptions.ProxyError(e)
+    except (httpx.NetworkError, httpx.RemoteProtocolError) as e:
+        raise exceptions.ConnectionError(e)
+    except httpx.UnsupportedProtocol as e:
+        raise exceptions.InvalidSchema(e)
+    except httpx.DecodingError as e:
+        raise exceptions.ContentDecodingError(e)
+    except httpx.TransportError as e:
+        raise exceptions.RequestException(e)
+
+
+transports = {
+        "requests": requestsSession,
+        "http2": Http2Transport,
+}
+
+
+class IronResponse(MutableMapping):
+    """The result of IronClient.request.
+
+    It behaves like the dict with "body", "status", "resp" and
+    "content-type" keys that request() has always returned, but is a
+    compact slotted object: a JSON body is only parsed the first time it is
+    read, response headers are available through headers, and release()
+    drops the underlying requests.Response (its raw content and
+    connection) once the body has been read. Other keys may be stored on it
+    like on a dict.
+    """
+
+    __slots__ = ("status", "content_type", "_resp", "_headers", "_body",
+                 "_loaded", "_codec", "_extra")
+
+    _keys = ("body", "status", "resp", "content-type")
+
+    def __init__(self, resp, status, content_type, codec=None, body=None,
+                 loaded=False):
+        self.status = status
+        self.content_type = content_type
+        self._resp = resp
+        self._headers = None
+        self._body = body
+        self._loaded = loaded
+        self._codec = codec
+        self._extra = None
+
+    @property
+    def body(self):
+        if not self._loaded:
+            resp = self._resp
+            self._body = decodeBody(self.content_type, resp.content,
+                                    lambda: resp.text, self._codec)[1]
+            self._loaded = True
+        return self._body
+
+    @property
+    def headers(self):
+        """The response headers."""
+        if self._resp is not None:
+            return self._resp.headers
+        return self._headers
+
+    @property
+    def resp(self):
+        """The underlying response, or None once released."""
+        return self._resp
+
+    def release(self):
+        """Parse the body if that has not happened yet and drop the reference
+        to the underlying response, keeping only its headers. Returns
+        self."""
+        if self._resp is not None:
+            self.body
+            self._headers = self._resp.headers
+            self._resp = None
+        return self
+
+    def __getitem__(self, key):
+        if key == "body":
+            return self.body
+        if key == "status":
+            return self.status
+        if key == "resp":
+            return self._resp
+        if key == "content-type":
+            return self.content_type
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key == "body":
+            self._body = value
+            self._loaded = True
+        elif key == "status":
+            self.status = value
+        elif key == "resp":
+            self._resp = value
+        elif key == "content-type":
+            self.content_type = value
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key == "resp":
+            self.release()
+        elif key in self._keys or self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __iter__(self):
+        for key in self._keys:
+            yield key
+        if self._extra is not None:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        return len(self._keys) + len(self._extra or ())
+
+    def __repr__(self):
+        return "IronResponse(%r)" % dict(self)
+
+
+class MetricsCollector(object):
+    """Count requests, retries, errors and Keystone token refreshes, and
+    record latency histograms, per product, HTTP method and endpoint.
+
+    Install it on any number of clients with install(client); it only
+    hooks into clients it is installed on, so clients without it pay
+    nothing. Read the numbers with snapshot().
+    """
+
+    # Upper bounds, in seconds, of the latency histogram buckets.
+    buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    _id_segment = re.compile(r"^(?:\d+|[0-9a-fA-F]{16,}|"
+                             r"[0-9a-fA-F]{8}-[0-9a-fA-F-]{27})$")
+
+    def __init__(self, buckets=None):
+        if buckets is not None:
+            self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        forkSafe(self)
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+    def install(self, client):
+        """Start recording the requests made by client."""
+        client.addHook("after_response", self._afterResponse)
+        client.addHook("on_retry", self._onRetry)
+        client.addHook("on_throttle", self._onThrottle)
+        client.addHook("on_token_refresh", self._onTokenRefresh)
+
+    def uninstall(self, client):
+        """Stop recording the requests made by client."""
+        client.removeHook("after_response", self._afterResponse)
+        client.removeHook("on_retry", self._onRetry)
+        client.removeHook("on_throttle", self._onThrottle)
+        client.removeHook("on_token_refresh", self._onTokenRefresh)
+
+    def endpoint(self, path):
+        """Return the endpoint name a request path is recorded under: the
+        path without its query string and with ID-like segments replaced by
+        ":id", so a metric does not exist per message or task."""
+        path = path.split("?", 1)[0]
+        return "/".join(":id" if self._id_segment.match(segment) else segment
+                        for segment in path.split("/"))
+
+    def _count(self, name, key, amount=1):
+        counter = (name,) + key
+        self._counters[counter] = self._counters.get(counter, 0) + amount
+
+    def _afterResponse(self, client, method, path, status, error, elapsed,
+                       **info):
+        key = (client.product, method, self.endpoint(path))
+        with self._lock:
+            self._count("requests", key)
+            if error is not None:
+                self._count("errors", key + (type(error).__name__,))
+            else:
+                self._count("responses", key + (status,))
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                        "counts": [0] * (len(self.buckets) + 1),
+                        "sum": 0.0, "count": 0}
+            index = 0
+            for bound in self.buckets:
+                if elapsed <= bound:
+                    break
+                index += 1
+            histogram["counts"][index] += 1
+            histogram["sum"] += elapsed
+            histogram["count"] += 1
+
+    def _onRetry(self, client, method, path, **info):
+        with self._lock:
+            self._count("retries", (client.product, method,
+                                    self.endpoint(path)))
+
+    def _onThrottle(self, client, method, path, delay, **info):
+        key = (client.product, method, self.endpoint(path))
+        with self._lock:
+            self._count("throttles", key)
+            self._count("throttle_seconds", key, delay)
+
+    def _onTokenRefresh(self, client, duration, elapsed, **info):
+        with self._lock:
+            self._count("token_refreshes", (client.product,))
+            self._count("token_refresh_seconds", (client.product,), elapsed)
+
+    def snapshot(self):
+        """Return a copy of the recorded metrics as a dict with "counters",
+        mapping (name, product, ...) tuples to numbers, and "latency",
+        mapping (product, method, endpoint) to a histogram dict with the
+        bucket "bounds", per-bucket "counts" (the last one counting
+        requests slower than every bound), "sum" and "count"."""
+        with self._lock:
+            latency = {}
+            for key, histogram in self._histograms.items():
+                latency[key] = {"bounds": self.buckets,
+                                "counts": list(histogram["counts"]),
+                                "sum": histogram["sum"],
+                                "count": histogram["count"]}
+            return {"counters": dict(self._counters), "latency": latency}
+
+
+class IronTimeoutError(Exception):
+    """Raised when a request times out or its deadline passes before it
+    could complete."""
+
+
+class RetryPolicy(object):
+    """Decide whether and when a failed request should be tried again.
+
+    A policy may be shared between clients and threads; it keeps running
+    counters of the retries it has granted in `retries`, `retried_statuses`
+    (keyed by HTTP status) and `retried_errors` (keyed by "connection" or
+    "timeout").
+    """
+
+    def __init__(self, status_codes=(503, 504), max_attempts=6, backoff=.5,
+                 multiplier=2, max_backoff=None, jitter=None, deadline=None,
+                 retry_connection_errors=False, retry_timeouts=False,
+                 error_methods=("GET", "PUT", "DELETE"),
+                 respect_retry_after=True, max_retry_after=None):
+        """Create a retry policy.
+
+        Keyword arguments:
+        status_codes -- HTTP status codes that should be retried. Defaults
+                        to (503, 504).
+        max_attempts -- The maximum number of attempts, including the first
+                        one. Defaults to 6.
+        backoff -- Seconds to wait before the first retry. Defaults to .5.
+        multiplier -- Factor the wait grows by after every retry. Defaults
+                      to 2.
+        max_backoff -- Upper bound on a single wait, in seconds. Defaults to
+                       None (unbounded).
+        jitter -- None for a fixed exponential schedule, "full" to wait a
+                  random time between zero and the exponential delay, or
+                  "decorrelated" to wait a random time between backoff and
+                  three times the previous wait. Defaults to None.
+        deadline -- Seconds after the first attempt past which no retry is
+                    started. Defaults to None (no deadline).
+        retry_connection_errors -- Whether connection failures are retried.
+                                   Defaults to False.
+        retry_timeouts -- Whether timed out requests are retried. Defaults
+                          to False.
+        error_methods -- The HTTP methods safe to resend after a connection
+                         error or timeout, where the server may already have
+                         acted on the request. Defaults to GET, PUT and
+                         DELETE.
+        respect_retry_after -- Whether a Retry-After response header takes
+                               precedence over the computed wait. Defaults to
+                               True.
+        max_retry_after -- The longest Retry-After wait honoured, in seconds.
+                           A response asking for a longer wait is not
+                           retried rather than blocking the caller. Defaults
+                           to max_backoff, or 8, the longest wait of the
+                           default schedule, if that is None.
+        """
+        if jitter not in (None, "full", "decorrelated"):
+            raise ValueError("Invalid jitter mode: %s" % jitter)
+        self.status_codes = frozenset(status_codes)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.multiplier = multiplier
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.deadline = deadline
+        self.retry_connection_errors = retry_connection_errors
+        self.retry_timeouts = retry_timeouts
+        self.error_methods = frozenset(error_methods)
+        self.respect_retry_after = respect_retry_after
+        if max_retry_after is None:
+            max_retry_after = max_backoff if max_backoff is not None else 8
+        self.max_retry_after = max_retry_after
+
+        self.retries = 0
+        self.retried_statuses = {}
+        self.retried_errors = {}
+        self._lock = threading.Lock()
+        forkSafe(self)
+
+    def nextDelay(self, method, attempt, elapsed, previous=None, status=None,
+                  retry_after=None, error=None):
+        """Return the number of seconds to wait before the next attempt, or
+        None if the request should not be retried.
+
+        Keyword arguments:
+        method -- The HTTP method of the request. Required.
+        attempt -- The number of attempts made so far. Required.
+        elapsed -- Seconds since the first attempt started. Required.
+        previous -- The previous wait returned for this request, if any.
+        status -- The HTTP status of the failed attempt, if it got a response.
+        retry_after -- The raw Retry-After header of that response, if any.
+        error -- "connection" or "timeout" if the attempt got no response.
+        """
+        if attempt >= self.max_attempts:
+            return None
+        if error is not None:
+            if method not in self.error_methods:
+                return None
+            if error == "timeout" and not self.retry_timeouts:
+                return None
+            if error == "connection" and not self.retry_connection_errors:
+                return None
+        elif status not in self.status_codes:
+            return None
+
+        if self.jitter == "decorrelated":
+            delay = random.uniform(self.backoff,
+                    max(self.backoff, (previous or self.backoff) * 3))
+        else:
+            delay = self.backoff * self.multiplier ** (attempt - 1)
+            if self.max_backoff is not None:
+                delay = min(delay, self.max_backoff)
+            if self.jitter == "full":
+                delay = random.uniform(0, delay)
+        if self.max_backoff is not None:
+            delay = min(delay, self.max_backoff)
+
+        if self.respect_retry_after and retry_after is not None:
+            server_delay = parseRetryAfter(retry_after)
+            if server_delay is not None:
+                if server_delay > self.max_retry_after:
+                    return None
+                delay = server_delay
+
+        if self.deadline is not None and elapsed + delay > self.deadline:
+            return None
+
+        with self._lock:
+            self.retries += 1
+            if error is not None:
+                self.retried_errors[error] = \
+                        self.retried_errors.get(error, 0) + 1
+            else:
+                self.retried_statuses[status] = \
+                        self.retried_statuses.get(status, 0) + 1
+        return delay
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request to a host whose circuit is
+    open."""
+
+    def __init__(self, host):
+        Exception.__init__(self, "Circuit open for %s" % host)
+        self.host = host
+
+
+class CircuitBreaker(object):
+    """Track request failures per host and stop sending requests to hosts
+    that keep failing.
+
+    A host's circuit opens when at least failure_rate of the requests
+    recorded in the last window seconds failed, once minimum_requests have
+    been seen. While open, requests to it are refused. After cooldown
+    seconds the circuit is half-open and lets a single probe request
+    through; its success closes the circuit, its failure opens it again.
+    A breaker may be shared between clients and threads.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_rate=.5, minimum_requests=5, window=10,
+                 cooldown=30):
+        self.failure_rate = failure_rate
+        self.minimum_requests = minimum_requests
+        self.window = window
+        self.cooldown = cooldown
+        self._hosts = {}
+        self._lock = threading.Lock()
+        forkSafe(self)
+
+    def _circuit(self, host):
+        circuit = self._hosts.get(host)
+        if circuit is None:
+            circuit = self._hosts[host] = {"state": self.CLOSED,
+                    "events": deque(), "opened_at": 0, "probe_at": None}
+        return circuit
+
+    def state(self, host):
+        """Return the state of host's circuit: CLOSED, OPEN or
+        HALF_OPEN."""
+        with self._lock:
+            circuit = self._circuit(host)
+            if circuit["state"] == self.OPEN and \
+                    monotonic() - circuit["opened_at"] >= self.cooldown:
+                return self.HALF_OPEN
+            return circuit["state"]
+
+    def allow(self, host):
+        """Return whether a request to host may be sent now. In the half-open
+        state only the first caller is allowed through as the probe."""
+        now = monotonic()
+        with self._lock:
+            circuit = self._circuit(host)
+            if circuit["state"] == self.CLOSED:
+                return True
+            if now - circuit["opened_at"] < self.cooldown:
+                return False
+            # A probe that never reported back is given up on after another
+            # cooldown so the circuit cannot stay stuck half-open.
+            if circuit["probe_at"] is not None and \
+                    now - circuit["probe_at"] < self.cooldown:
+                return False
+            circuit["state"] = self.HALF_OPEN
+            circuit["probe_at"] = now
+            return True
+
+    def record(self, host, success):
+        """Record the outcome of a request sent to host."""
+        now = monotonic()
+        with self._lock:
+            circuit = self._circuit(host)
+            if circuit["state"] == self.HALF_OPEN:
+                circuit["probe_at"] = None
+                circuit["events"].clear()
+                if success:
+                    circuit["state"] = self.CLOSED
+                else:
+                    circuit["state"] = self.OPEN
+                    circuit["opened_at"] = now
+                return
+            if circuit["state"] == self.OPEN:
+                return
+
+            events = circuit["events"]
+            events.append((now, success))
+            while events and now - events[0][0] > self.window:
+                events.popleft()
+            if len(events) >= self.minimum_requests:
+                failures = sum(1 for event in events if not event[1])
+                if failures >= self.failure_rate * len(events):
+                    circuit["state"] = self.OPEN
+                    circuit["opened_at"] = now
+                    events.clear()
+
+
+class TokenBucket(object):
+    """A token bucket holding up to burst tokens, refilled at rate tokens
+    per second. A bucket may be shared between threads.
+    """
+
+    def __init__(self, rate, burst=None):
+        """Create a full bucket.
+
+        Keyword arguments:
+        rate -- Tokens added per second. Required.
+        burst -- The most tokens the bucket holds, i.e. how many calls may
+                 be made at once after a quiet period. Defaults to rate, or
+                 1 if rate is lower.
+        """
+        if rate <= 0:
+            raise ValueError("Invalid rate: %s" % rate)
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self._level = self.burst
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+        forkSafe(self)
+
+    def _take(self, level, updated, now, tokens, timeout):
+        level = min(self.burst, level + max(0.0, now - updated) * self.rate)
+        wait = max(0.0, (tokens - level) / self.rate)
+        if timeout is not None and wait > timeout:
+            return None, level
+        return wait, min(self.burst, level - tokens)
+
+    def reserve(self, tokens=1, timeout=None):
+        """Take tokens and return the seconds to wait before they may be
+        used; the level goes negative rather than making later callers
+        jump the queue. Returns None and takes nothing if the wait would
+        exceed timeout. A negative amount returns unused tokens."""
+        with self._lock:
+            now = monotonic()
+            wait, self._level = self._take(self._level, self._updated, now,
+                                           tokens, timeout)
+            self._updated = now
+            return wait
+
+    def acquire(self, tokens=1, timeout=None):
+        """Wait until tokens are available and take them. Returns False
+        without waiting if that would take longer than timeout."""
+        wait = self.reserve(tokens, timeout)
+        if wait is None:
+            return False
+        if wait:
+            time.sleep(wait)
+        return True
+
+
+class SharedTokenBucket(TokenBucket):
+    """A TokenBucket whose level is kept in a locked file, so it is shared by
+    every process on the host that uses the same path.
+    """
+
+    def __init__(self, path, rate, burst=None):
+        """Create a bucket backed by path, which is created full if it does
+        not exist yet. rate and burst are as for TokenBucket."""
+        TokenBucket.__init__(self, rate, burst)
+        self.path = path
+
+    def reserve(self, tokens=1, timeout=None):
+        with self._lock:
+            with lockedFile(self.path) as fd:
+                now = time.time()
+                try:
+                    state = json.loads(readFile(fd).decode("utf-8"))
+                    level, updated = state["level"], state["updated"]
+                except (ValueError, KeyError, TypeError):
+                    level, updated = self.burst, now
+                wait, level = self._take(level, updated, now, tokens,
+                                         timeout)
+                state = {"level": level, "updated": now}
+                writeFile(fd, json.dumps(state).encode("utf-8"))
+                return wait
+
+
+class RateLimiter(object):
+    """Limit the rate of requests per product, project or endpoint with
+    token buckets, so bursts are smoothed out before the server has to
+    throttle them.
+
+    Each rule is an fnmatch pattern matched against
+    "product/project_id/path", e.g. "iron_mq/*" for everything sent to
+    IronMQ, "*/my-project/*" for one project, or
+    "iron_mq/*/queues/*/messages" for one endpoint, with the rate and
+    burst of the bucket every matching request draws from. A request
+    waits for a token from each rule it matches. A limiter may be shared
+    between clients and threads, and between processes when directory is
+    given.
+    """
+
+    # Request keys whose matching buckets are remembered.
+    match_cache_size = 1024
+
+    def __init__(self, rules, directory=None):
+        """Create a limiter.
+
+        Keyword arguments:
+        rules -- A list of (pattern, rate) or (pattern, rate, burst) tuples,
+                 or a dict mapping patterns to a rate or a (rate, burst)
+                 tuple. Required.
+        directory -- A directory in which to keep the bucket levels so that
+                     every process on the host using it shares them.
+                     Defaults to None (buckets are local to the process).
+        """
+        if isinstance(rules, dict):
+            rules = [(pattern,) + (limit if isinstance(limit, tuple)
+                                   else (limit,))
+                     for pattern, limit in rules.items()]
+        self.directory = directory
+        self.rules = []
+        for rule in rules:
+            pattern, rate = rule[0], rule[1]
+            burst = rule[2] if len(rule) > 2 else None
+            if directory is None:
+                bucket = TokenBucket(rate, burst)
+            else:
+                name = hashlib.sha1(pattern.encode("utf-8")).hexdigest()
+                bucket = SharedTokenBucket(os.path.join(directory,
+                        "iron-rate-%s.json" % name), rate, burst)
+            self.rules.append((pattern, bucket))
+        self._matches = {}
+
+    def buckets(self, product, project_id, path):
+        """Return the buckets a request for path must take a token from."""
+        key = "%s/%s/%s" % (product, project_id, path.split("?")[0])
+        buckets = self._matches.get(key)
+        if buckets is None:
+            buckets = tuple(bucket for pattern, bucket in self.rules
+                            if fnmatch.fnmatchcase(key, pattern))
+            if len(self._matches) >= self.match_cache_size:
+                self._matches = {}
+            self._matches[key] = buckets
+        return buckets
+
+    def reserve(self, product, project_id, path, timeout=None):
+        """Take a token for a request and return the seconds to wait before
+        sending it, or None, taking nothing, if that would exceed
+        timeout."""
+        taken = []
+        wait = 0.0
+        for bucket in self.buckets(product, project_id, path):
+            delay = bucket.reserve(1, timeout)
+            if delay is None:
+                for bucket in taken:
+                    bucket.reserve(-1)
+                return None
+            taken.append(bucket)
+            wait = max(wait, delay)
+        return wait
+
+    def acquire(self, product, project_id, path, timeout=None):
+        """Wait until a request may be sent. Returns False without waiting
+        if that would take longer than timeout."""
+        wait = self.reserve(product, project_id, path, timeout)
+        if wait is None:
+            return False
+        if wait:
+            time.sleep(wait)
+        return True
+
+
+class HostSelector(object):
+    """Track the latency and error rate of every endpoint a client can send
+    to and rank them, fastest healthy endpoint first.
+
+    Both are exponentially weighted moving averages, weighting each new
+    request by alpha. An endpoint whose error rate is above max_error_rate
+    is ranked after every healthy one until it has not been used for
+    recovery seconds, after which it is given another chance. Endpoints
+    that have not been used yet are ranked first, in the order given, so
+    every endpoint gets measured. A selector may be shared between clients
+    and threads.
+    """
+
+    def __init__(self, alpha=.3, max_error_rate=.5, recovery=30):
+        self.alpha = alpha
+        self.max_error_rate = max_error_rate
+        self.recovery = recovery
+        self._hosts = {}
+        self._lock = threading.Lock()
+        forkSafe(self)
+
+    def record(self, host, elapsed, success):
+        """Record that a request to host took elapsed seconds and whether it
+        succeeded."""
+        alpha = self.alpha
+        with self._lock:
+            stats = self._hosts.get(host)
+            if stats is None:
+                stats = self._hosts[host] = {"latency": elapsed,
+                        "errors": 0.0 if success else 1.0}
+            else:
+                stats["latency"] += alpha * (elapsed - stats["latency"])
+                stats["errors"] += alpha * ((0.0 if success else 1.0) -
+                                            stats["errors"])
+            stats["updated"] = monotonic()
+
+    def stats(self, host):
+        """Return the latency and error rate averages recorded for host as a
+        dict, or None if none were recorded."""
+        with self._lock:
+            stats = self._hosts.get(host)
+            return dict(stats) if stats is not None else None
+
+    def rank(self, hosts):
+        """Return hosts ordered from the most to the least preferred."""
+        now = monotonic()
+        scores = []
+        with self._lock:
+            for index, host in enumerate(hosts):
+                stats = self._hosts.get(host)
+                if stats is None:
+                    score = (0, 0.0)
+                elif stats["errors"] > self.max_error_rate and \
+                        now - stats["updated"] < self.recovery:
+                    score = (2, stats["errors"])
+                else:
+                    score = (1, stats["latency"])
+                scores.append((score, index, host))
+        scores.sort()
+        return [host for score, index, host in scores]
+
+
+class RequestCoalescer(object):
+    """Let identical calls that are in flight at the same time share one
+    execution: the first caller runs it and everyone who asks for the same
+    key meanwhile waits for, and receives, its outcome. A coalescer may be
+    shared between clients and threads.
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+        forkSafe(self)
+
+    def _afterFork(self):
+        # The calls in flight belong to threads of the parent.
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, args=(), timeout=None):
+        """Return func(*args), or the result of the call with the same key
+        already in flight. Exceptions are raised to every caller. Waiting
+        for another caller's call raises IronTimeoutError after timeout
+        seconds."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = {"done": threading.Event(),
+                                           "result": None, "error": None}
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+
+        if leader:
+            try:
+                call["result"] = func(*args)
+                return call["result"]
+            except BaseException as e:
+                call["error"] = e
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call["done"].set()
+
+        if not call["done"].wait(timeout):
+            raise IronTimeoutError("Timed out after %ss waiting for a "
+                                   "coalesced request" % timeout)
+        if call["error"] is not None:
+            raise call["error"]
+        return call["result"]
+
+
+class ResponseCache(object):
+    """An in-process LRU cache of GET responses, shared by the clients it is
+    given to.
+
+    A cached response is served without a round-trip until its TTL
+    expires. After that it is revalidated with If-None-Match or
+    If-Modified-Since when the server sent an ETag or Last-Modified
+    header, and refetched otherwise. POST, PUT, PATCH and DELETE requests
+    through a client invalidate the cached responses for the same path,
+    the paths below it and the paths above it, e.g. a POST to
+    queues/q/messages drops queues/q/messages, queues/q and queues.
+    """
+
+    def __init__(self, ttl=60, max_entries=256, ttls=None):
+        """Create an empty cache.
+
+        Keyword arguments:
+        ttl -- Seconds a response is served from the cache before it must be
+               revalidated. 0 revalidates every time. Defaults to 60.
+        max_entries -- The number of responses kept; the least recently
+                       used is evicted first. Defaults to 256.
+        ttls -- A list of (pattern, ttl) pairs, or a dict, overriding ttl for
+                the request paths matching the fnmatch pattern, e.g.
+                {"codes*": 300, "queues/*": 5}. A ttl of None disables
+                caching for those paths. The first match wins. Defaults to
+                None.
+        """
+        self.default_ttl = ttl
+        self.max_entries = max_entries
+        if isinstance(ttls, dict):
+            ttls = ttls.items()
+        self.ttls = list(ttls or ())
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        forkSafe(self)
+
+    def ttl(self, path):
+        """Return the TTL of responses to path, or None if they should not
+        be cached."""
+        path = path.split("?")[0]
+        for pattern, ttl in self.ttls:
+            if fnmatch.fnmatchcase(path, pattern):
+                return ttl
+        return self.default_ttl
+
+    def lookup(self, key, headers):
+        """Return (response, entry, headers) for a GET about to be sent
+        with key: the cached response if it is still fresh, else the stale
+        entry, if any, and headers with its validators added."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["expires"] > monotonic():
+                self._entries[key] = self._entries.pop(key)
+                self.hits += 1
+                return entry["resp"], None, headers
+            self.misses += 1
+        if entry is None:
+            return None, None, headers
+        if entry["validators"]:
+            headers = dict(headers)
+            headers.update(entry["validators"])
+        return None, entry, headers
+
+    def store(self, key, url, path, resp, status, stale=None):
+        """Cache resp, the response to the GET sent with key, and return the
+        response to use: the stale entry's if the server answered 304 Not
+        Modified."""
+        if status == 304 and stale is not None:
+            resp = stale["resp"]
+            status = 200
+            with self._lock:
+                self.revalidations += 1
+        ttl = self.ttl(path)
+        if status != 200 or ttl is None or \
+                "no-store" in resp.headers.get("Cache-Control", ""):
+            return resp
+        validators = {}
+        if resp.headers.get("ETag"):
+            validators["If-None-Match"] = resp.headers["ETag"]
+        if resp.headers.get("Last-Modified"):
+            validators["If-Modified-Since"] = resp.headers["Last-Modified"]
+        entry = {"resp": resp, "resource": url.split("?")[0],
+                 "expires": monotonic() + ttl,
+                 "validators": asciiHeaders(validators)}
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return resp
+
+    def invalidate(self, url):
+        """Drop the cached responses for url, the URLs below it and the URLs
+        above it."""
+        resource = url.split("?")[0].rstrip("/")
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                cached = entry["resource"].rstrip("/")
+                if cached == resource or \
+                        resource.startswith(cached + "/") or \
+                        cached.startswith(resource + "/"):
+                    del self._entries[key]
+
+    def clear(self):
+        """Drop every cached response."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _Attempts(object):
+    """The attempts of one call through IronClient._send and the decisions
+    taken around them: throttling, the endpoint and timeout of each
+    attempt, and whether, and after how long, to try again. The sync and
+    async clients drive it from loops that differ only in how they send
+    and wait."""
+
+    def __init__(self, client, url, path, method, rewind, retry, deadline):
+        self.client = client
+        self.url = url
+        self.path = path
+        self.method = method
+        self.rewind = rewind
+        self.deadline = deadline
+        self.policy = client._retryPolicy(retry)
+        self.breaker = client.circuit_breaker
+        self.hooks = client._hooks
+        self.selector = client.host_selector if len(client.hosts) > 1 \
+                else None
+        self.tried = [] if method in client.idempotent_methods else None
+        self.host = client.host
+        self.target = url
+        self.started = monotonic()
+        self.attempt = 0
+        self.delay = None
+        self.response = None
+        self.error = None
+        self.exc = None
+
+    def throttle(self):
+        """Start the next attempt and return the seconds the rate limiter
+        asks to wait before sending it."""
+        self.attempt += 1
+        client = self.client
+        if client.rate_limiter is None:
+            return 0
+        wait = client._reserveRate(self.path, self.started, self.deadline)
+        if wait and self.hooks:
+            client._emit("on_throttle", method=self.method, url=self.url,
+                    path=self.path, attempt=self.attempt, delay=wait)
+        return wait
+
+    def begin(self):
+        """Pick the endpoint of the attempt and return its URL and timeout,
+        or None if a circuit opened while retrying and the last response is
+        the result. Raises CircuitOpenError if no attempt could be made,
+        and the last failure if the circuit opened after it."""
+        client = self.client
+        timeout = client._attemptTimeout(self.started, self.deadline)
+        host = self.host
+        if self.selector is not None:
+            host = client._pickHost(self.tried, self.breaker)
+            if host is not None:
+                self.target = client._hostUrl(self.url, host)
+        elif self.breaker is not None and not self.breaker.allow(host):
+            host = None
+        if host is None:
+            if self.attempt == 1:
+                raise CircuitOpenError(client.host)
+            # The circuit opened while retrying; report the last failure.
+            if self.error is not None:
+                raise self.exc
+            return None
+        self.host = host
+        self.error = self.exc = None
+        if self.hooks:
+            client._emit("before_request", method=self.method,
+                    url=self.target, path=self.path, attempt=self.attempt)
+        return self.target, timeout
+
+    def finish(self, r, exc, elapsed, server_time):
+        """Record the outcome of the attempt, either the response r or the
+        connection error or IronTimeoutError exc, and return the seconds to
+        wait before retrying, or None if r is the result. Raises exc if it
+        is not retried, and IronTimeoutError if the retry would run past
+        the deadline."""
+        client = self.client
+        method = self.method
+        if exc is not None:
+            error = "timeout" if isinstance(exc, IronTimeoutError) \
+                    else "connection"
+            status = None
+        else:
+            error = None
+            status = client._responseStatus(r)
+            self.response = r
+        self.error, self.exc = error, exc
+        if self.hooks:
+            client._emit("after_response", method=method, url=self.target,
+                    path=self.path, attempt=self.attempt, status=status,
+                    error=exc, elapsed=elapsed,
+                    server_time=None if error else server_time,
+                    response=None if error else r)
+        success = error is None and status < 500
+        if self.breaker is not None:
+            self.breaker.record(self.host, success)
+        if self.selector is not None:
+            self.selector.record(self.host, elapsed, success)
+        policy = self.policy
+        if policy is None:
+            delay = None
+        elif not success and self.selector is not None and \
+                self.tried is not None and \
+                len(self.tried) < len(client.hosts):
+            # Fail over to an endpoint this call has not tried yet.
+            delay = 0.0
+        elif error is not None:
+            delay = policy.nextDelay(method, self.attempt,
+                    monotonic() - self.started, self.delay, error=error)
+        else:
+            delay = policy.nextDelay(method, self.attempt,
+                    monotonic() - self.started, self.delay, status=status,
+                    retry_after=r.headers.get("Retry-After"))
+        self.delay = delay
+        # A generator body was consumed by the attempt and cannot be sent
+        # again.
+        if delay is None or self.rewind is None:
+            if error is not None:
+                raise exc
+            return None
+        if self.deadline is not None and \
+                monotonic() - self.started + delay >= self.deadline:
+            raise IronTimeoutError("Deadline of %ss exceeded for %s" %
+                    (self.deadline, self.target))
+        if self.hooks:
+            client._emit("on_retry", method=method, url=self.target,
+                    path=self.path, attempt=self.attempt, delay=delay,
+                    status=status, error=exc)
+        if error is None:
+            client._discardResponse(r)
+        return delay
 
 
 class IronClient(object):
     __version__ = "1.2.0"
 
+    # Bytes read from the network at a time by streamed responses.
+    stream_chunk_size = 65536
+
     def __init__(self, name, version, product, host=None, project_id=None,
                  token=None, protocol=None, port=None, api_version=None,
-                 config_file=None, keystone=None, cloud=None, path_prefix=''):
+                 config_file=None, keystone=None, cloud=None, path_prefix='',
+                 pool_connections=None, pool_maxsize=None,
+                 pool_idle_timeout=None, retry_policy=None,
+                 circuit_breaker=None, connect_timeout=None,
+                 read_timeout=None, json_codec=None, keep_response=True,
+                 compression=None, compression_threshold=None,
+                 compression_level=None, config=None, rate_limiter=None,
+                 coalescer=None, host_selector=None, response_cache=None,
+                 transport=None, pool_block=None):
         """Prepare a Client that can make HTTP calls and return it.
 
         Keyword arguments:
         name -- the name of the client. Required.
         version -- the version of the client. Required.
         product -- the name of the product the client will access. Required.
-        host -- the default domain the client will be requesting. Defaults
-                to None.
+        host -- the default domain the client will be requesting, or a list
+                of equivalent endpoints (a comma separated string in
+                environment variables) to spread requests over and fail
+                over between. Endpoints may be given as host:port.
+                Defaults to None.
         project_id -- the project ID the client will be requesting. Can be
                       found on http://hud.iron.io. Defaults to None.
         token -- an API token found on http://hud.iron.io. Defaults to None.
@@ -89,48 +1549,92 @@ class IronClient(object):
                        requests. Defaults to None.
         config_file -- The config file to load configuration from. Defaults to
                        None.
+        pool_connections -- The number of per-host connection pools to keep.
+                            Defaults to 10.
+        pool_maxsize -- The maximum number of connections to keep open per
+                        host for reuse. Without pool_block, requests beyond
+                        it still open connections, which are closed after
+                        use. Defaults to 10.
+        pool_block -- Whether requests wait for one of the pool_maxsize
+                      connections to a host instead of opening more, making
+                      pool_maxsize a hard limit. AsyncIronClient and the
+                      http2 transport always wait. Defaults to False.
+        pool_idle_timeout -- Seconds a session may sit unused before its
+                             connections are discarded and reopened on the
+                             next request. Defaults to None (never).
+        retry_policy -- The RetryPolicy used by requests made with retry=True.
+                        Defaults to a policy that retries 503 and 504
+                        responses five times, doubling a .5 second wait, or
+                        waiting as long as Retry-After asks, up to 8
+                        seconds.
+        circuit_breaker -- A CircuitBreaker to fail fast with
+                           CircuitOpenError while the host is unhealthy, or
+                           True for one with default thresholds. Defaults to
+                           None (no breaker).
+        connect_timeout -- Seconds to wait for a connection to be established.
+                           Defaults to None (wait forever).
+        read_timeout -- Seconds to wait for the server to send data. Defaults
+                        to None (wait forever).
+        json_codec -- The JsonCodec, or the name of one of json_codecs, used
+                      to encode request bodies and decode responses.
+                      Defaults to the fastest one installed.
+        keep_response -- Whether results keep a reference to the underlying
+                         response under "resp". If False the body is read
+                         and the response released before request()
+                         returns. Defaults to True.
+        compression -- "gzip" or "deflate" to compress POST, PUT and PATCH
+                       bodies of at least compression_threshold bytes.
+                       Streamed bodies are sent as they are. Compressed
+                       responses are decoded either way. Defaults to None
+                       (no request compression).
+        compression_threshold -- The smallest body, in bytes, worth
+                                 compressing. Defaults to 1024.
+        compression_level -- The zlib compression level, from 1 (fastest)
+                             to 9 (smallest). Defaults to 6.
+        config -- A configuration dict returned by resolveConfig, to share
+                  one resolution between many clients instead of reading
+                  the config files and environment again. config_file is
+                  ignored when it is given. The other arguments still
+                  override it. Defaults to None.
+        rate_limiter -- A RateLimiter every attempt, retries included, must
+                        get a token from before it is sent. Defaults to None
+                        (no client-side limit).
+        coalescer -- A RequestCoalescer through which identical GET requests
+                     (same URL, headers and credentials) that are in flight
+                     at the same time share a single round-trip, or True
+                     for one private to this client. Every caller gets its
+                     own result. Streamed GETs are never coalesced. Defaults
+                     to None (every call is sent).
+        host_selector -- The HostSelector ranking the endpoints when host
+                         lists several. Each attempt goes to the
+                         best-ranked endpoint; failed attempts of
+                         idempotent methods are retried at once on the next
+                         endpoint not yet tried. Defaults to a new
+                         HostSelector.
+        response_cache -- A ResponseCache to serve repeated GET requests
+                          from, or True for one private to this client with
+                          the default TTL. Defaults to None (no caching).
+        transport -- The name of the transport in transports that sends the
+                     requests: "requests" for HTTP/1.1 connection pools, or
+                     "http2" to multiplex concurrent requests over one
+                     HTTP/2 connection per host (needs httpx). A callable
+                     taking the client and returning a transport may be
+                     given instead. AsyncIronClient always uses aiohttp.
+                     Defaults to "requests".
         """
-        config = {
-                "host": None,
-                "protocol": "https",
-                "port": 443,
-                "api_version": None,
-                "project_id": None,
-                "token": None,
-                "keystone": None,
-                "path_prefix": None,
-                "cloud": None,
-        }
-        products = {
-                "iron_worker": {
-                    "host": "worker-aws-us-east-1.iron.io",
-                    "version": 2
-                },
-                "iron_mq": {
-                    "host": "mq-aws-us-east-1-1.iron.io",
-                    "version": 3
-                },
-                "iron_cache": {
-                    "host": "cache-aws-us-east-1.iron.io",
-                    "version": 1
-                }
-        }
-        if product in products:
-            config["host"] = products[product]["host"]
-            config["api_version"] = products[product]["version"]
-        
-        try:
-            config = configFromFile(config,
-                    os.path.expanduser("~/.iron.json"), product)
-        except:
-            pass
-        config = configFromEnv(config)
-        config = configFromEnv(config, product)
-        config = configFromFile(config, "iron.json", product)
-        config = configFromFile(config, config_file, product)
+        if config is None:
+            config = resolveConfig(product, config_file)
+        else:
+            config = dict(config)
         config = configFromArgs(config, host=host, project_id=project_id,
                 token=token, protocol=protocol, port=port,
-                api_version=api_version, keystone=keystone, cloud=cloud, path_prefix=path_prefix)
+                api_version=api_version, keystone=keystone, cloud=cloud, path_prefix=path_prefix,
+                pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                pool_idle_timeout=pool_idle_timeout, pool_block=pool_block,
+                connect_timeout=connect_timeout, read_timeout=read_timeout,
+                compression=compression,
+                compression_threshold=compression_threshold,
+                compression_level=compression_level, transport=transport)
 
         required_fields = ["project_id"]
 
@@ -142,7 +1646,10 @@ class IronClient(object):
         if config["keystone"] is not None:
             keystone_required_keys = ["server", "tenant", "username", "password"]
             if len(intersect(keystone_required_keys, config["keystone"].keys())) == len(keystone_required_keys):
-                self.token_provider = KeystoneTokenProvider(config["keystone"])
+                self.token_provider = KeystoneTokenProvider(config["keystone"],
+                        timeout=(optionalFloat(config["connect_timeout"]),
+                                 optionalFloat(config["read_timeout"])))
+                self.token_provider.listeners.append(self._tokenRefreshed)
                 keystone_configured = True
             else:
                 raise ValueError("Missing keystone keys.")
@@ -157,7 +1664,16 @@ class IronClient(object):
         self.name = name
         self.version = version
         self.product = product
-        self.host = config["host"]
+        hosts = config["host"]
+        if isinstance(hosts, (list, tuple)):
+            hosts = list(hosts)
+        elif hosts is not None and "," in hosts:
+            hosts = [host.strip() for host in hosts.split(",")
+                     if host.strip()]
+        else:
+            hosts = [hosts]
+        self.host = hosts[0]
+        self.hosts = hosts
         self.project_id = config["project_id"]
         self.token = config["token"]
         self.keystone = config["keystone"]
@@ -165,6 +1681,58 @@ class IronClient(object):
         self.port = config["port"]
         self.api_version = config["api_version"]
         self.cloud = config["cloud"]
+        self.pool_connections = int(config["pool_connections"])
+        self.pool_maxsize = int(config["pool_maxsize"])
+        self.pool_idle_timeout = optionalFloat(config["pool_idle_timeout"])
+        self.pool_block = configFlag(config["pool_block"])
+        self.connect_timeout = optionalFloat(config["connect_timeout"])
+        self.read_timeout = optionalFloat(config["read_timeout"])
+        self.compression = config["compression"]
+        if self.compression not in (None, "gzip", "deflate"):
+            raise ValueError("Invalid compression: %s" % self.compression)
+        self.compression_threshold = int(config["compression_threshold"])
+        self.compression_level = int(config["compression_level"])
+        transport = config["transport"]
+        if not callable(transport):
+            if transport not in transports:
+                raise ValueError("Unknown transport: %s" % transport)
+            transport = transports[transport]
+        if transport is Http2Transport:
+            # Fail now rather than on the first request.
+            loadHttpx()
+        self.transport = transport
+
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self.retry_policy = retry_policy
+        if circuit_breaker is True:
+            circuit_breaker = CircuitBreaker()
+        self.circuit_breaker = circuit_breaker
+        if json_codec is None or isinstance(json_codec, str):
+            json_codec = findJsonCodec(json_codec)
+        self.json_codec = json_codec
+        self.keep_response = keep_response
+        self.rate_limiter = rate_limiter
+        if coalescer is True:
+            coalescer = RequestCoalescer()
+        self.coalescer = coalescer
+        if response_cache is True:
+            response_cache = ResponseCache()
+        self.response_cache = response_cache
+        if self.keystone is not None:
+            self._auth_identity = ("keystone", self.keystone["server"],
+                    self.keystone["tenant"], self.keystone["username"])
+        else:
+            self._auth_identity = self.token
+
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._session_used_at = 0
+        forkSafe(self)
+        self._auth = None
+        self._hooks = {}
+        self._url_cache = {}
+        self._url_cache_base = None
 
         self.headers = {
                 "Accept": "application/json",
@@ -176,100 +1744,493 @@ class IronClient(object):
             url = urlparse(self.cloud)
             self.protocol = url.scheme
             self.host = url.netloc.split(":")[0]
+            self.hosts = [self.host]
             if url.port:
                 self.port = url.port
             self.path_prefix = url.path.rstrip("/")
 
-        if self.protocol == "https" and self.port == 443:
-            self.base_url = "%s://%s%s/%s/" % (self.protocol, self.host, self.path_prefix, self.api_version)
+        self._base_urls = dict((host, self._baseUrl(host))
+                               for host in self.hosts)
+        self.base_url = self._base_urls[self.host]
+        if len(self.hosts) > 1 and host_selector is None:
+            host_selector = HostSelector()
+        self.host_selector = host_selector
+
+    def _baseUrl(self, host):
+        # An endpoint listed as host:port keeps its own port.
+        if (host is not None and ":" in host) or \
+                (self.protocol == "https" and self.port == 443):
+            base_url = "%s://%s%s/%s/" % (self.protocol, host, self.path_prefix, self.api_version)
         else:
-            self.base_url = "%s://%s:%s%s/%s/" % (self.protocol, self.host,
-                                                self.port, self.path_prefix, self.api_version)
+            base_url = "%s://%s:%s%s/%s/" % (self.protocol, host,
+                                           self.port, self.path_prefix, self.api_version)
         if self.project_id:
-            self.base_url += "projects/%s/" % self.project_id
+            base_url += "projects/%s/" % self.project_id
+        return base_url
+
+    @property
+    def headers(self):
+        """The default headers sent with every request. They are prepared
+        once, so the mapping is read-only; assign a new dict to change
+        them."""
+        return self._headers_view
+
+    @headers.setter
+    def headers(self, headers):
+        self._default_headers = asciiHeaders(dict(headers))
+        self._headers_view = readOnlyView(self._default_headers)
+        self._auth = None
+
+    def _newSession(self):
+        return self.transport(self)
+
+    def _getSession(self):
+        """Return the transport with its pool of keep-alive connections,
+        opening a new one if none exists yet or the current one has been
+        idle for longer than pool_idle_timeout."""
+        now = monotonic()
+        session = self._session
+        if session is None or (self.pool_idle_timeout is not None and
+                now - self._session_used_at > self.pool_idle_timeout):
+            with self._session_lock:
+                if self._session is session:
+                    if session is not None:
+                        session.close()
+                    self._session = self._newSession()
+                session = self._session
+        self._session_used_at = now
+        return session
+
+    def _afterFork(self):
+        # The pooled sockets are shared with the parent; drop them without
+        # closing so the parent's connections are left alone.
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    def close(self):
+        """Close all pooled connections held by the client. The client may
+        still be used afterwards; a new pool is opened on the next request."""
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
 
-    def _doRequest(self, url, method, body="", headers={}):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _doRequest(self, url, method, body="", headers={}, timeout=None,
+                   stream=False):
         if self.token or self.keystone:
-            headers["Authorization"] = "OAuth %s" % self.token_provider.getToken()
+            headers = self._authorize(headers,
+                    self.token_provider.getToken())
 
-        if method == "GET":
-            r = requests.get(url, headers=headers)
-        elif method == "POST":
-            r = requests.post(url, data=body, headers=headers)
-        elif method == "PUT":
-            r = requests.put(url, data=body, headers=headers)
-        elif method == "DELETE":
-            r = requests.delete(url, data=body, headers=headers)
-        elif method == "PATCH":
-            r = requests.patch(url, data=body, headers=headers)
-        else:
+        if method not in ("GET", "POST", "PUT", "DELETE", "PATCH"):
             raise ValueError("Invalid HTTP method")
-        return r
+        if method == "GET":
+            body = None
+        return self._getSession().request(method, url, data=body,
+                headers=headers, timeout=timeout, stream=stream)
 
-    def request(self, url, method, body="", headers={}, retry=True):
-        """Execute an HTTP request and return a dict containing the response
-        and the response status code.
+    def request(self, url, method, body="", headers={}, retry=True,
+                deadline=None, stream=False, decode=True):
+        """Execute an HTTP request and return an IronResponse, a dict-like
+        object containing the response and the response status code.
 
         Keyword arguments:
         url -- The path to execute the result against, not including the API
                version or project ID, with no leading /. Required.
         method -- The HTTP method to use. Required.
-        body -- A string or file object to send as the body of the request.
+        body -- A string, bytes-like object, file object, generator of byte
+                chunks or MultipartEncoder to send as the body of the
+                request. Text is sent UTF-8 encoded and generators with
+                chunked transfer encoding. A dict or list is sent as JSON.
                 Defaults to an empty string.
         headers -- HTTP Headers to send with the request. Can overwrite the
                    defaults. Defaults to {}.
-        retry -- Whether exponential backoff should be employed. Defaults
-                 to True.
+        retry -- Whether exponential backoff should be employed, or the
+                 RetryPolicy to use for this call. Defaults to True.
+        deadline -- Seconds the call may take in total, across all retries,
+                    before IronTimeoutError is raised. Defaults to None (no
+                    deadline).
+        stream -- Return the body as an iterator instead of reading it all
+                  into memory: True or "chunks" for raw byte chunks, "lines"
+                  for byte lines, or "json" for the items of a JSON array
+                  body, decoded one at a time. The connection is released
+                  once the iterator is exhausted or closed. Defaults to
+                  False.
+        decode -- Whether to decode the body. If False the body is returned
+                  as the raw bytes received, for callers that parse it
+                  themselves. Defaults to True.
         """
-        if headers:
-            headers = dict(list(headers.items()) + list(self.headers.items()))
+        if stream not in (False, True, "chunks", "lines", "json"):
+            raise ValueError("Invalid stream mode: %s" % stream)
+        if checkFork is not None:
+            checkFork()
+        path = url
+        url, headers = self._prepareRequest(url, headers)
+        if isinstance(body, (dict, list)):
+            body, headers = self._encodeJson(body, headers)
+        body = encodeBody(body)
+        if self.compression is not None and \
+                method in self.compressed_methods:
+            body, headers = self._compress(body, headers)
+        rewind = bodyRewinder(body)
+
+        cache = self.response_cache
+        if method == "GET" and not stream and \
+                (cache is not None or self.coalescer is not None):
+            r = self._sendGet(url, path, body, headers, rewind, retry,
+                    deadline)
+        elif cache is not None and method != "GET":
+            try:
+                r = self._send(url, path, method, body, headers, rewind,
+                        retry, deadline, stream)
+            finally:
+                cache.invalidate(url)
+        else:
+            r = self._send(url, path, method, body, headers, rewind, retry,
+                    deadline, stream)
+
+        contentType = (r.headers.get("Content-Type") or
+                "text/plain").split(";")[0]
+        if stream:
+            result = IronResponse(r, r.status_code, contentType,
+                    body=self._streamBody(r, stream), loaded=True)
+        elif not decode:
+            result = IronResponse(r, r.status_code, contentType,
+                    body=r.content, loaded=True)
         else:
-            headers = self.headers
-
-        if not sys.version_info >= (3,) and headers:
-            headers = dict((k.encode('ascii') if isinstance(k, unicode) else k,
-                            v.encode('ascii') if isinstance(v, unicode) else v)
-                           for k, v in headers.items())
-
-        url = self.base_url + url
-        if not sys.version_info >= (3,):
-            if isinstance(url, unicode):
-                url = url.encode('ascii')
-
-        r = self._doRequest(url, method, body, headers)
-
-        retry_http_codes = [503, 504]
-        if r.status_code in retry_http_codes and retry:
-            tries = 5
-            delay = .5
-            backoff = 2
-            while r.status_code in retry_http_codes and tries > 0:
-                tries -= 1
+            result = IronResponse(r, r.status_code, contentType,
+                    self.json_codec)
+        if not self.keep_response and not stream:
+            result.release()
+        return result
+
+    # Methods whose failed attempts may be repeated on another endpoint.
+    idempotent_methods = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+
+    def _pickHost(self, tried, breaker):
+        """Return the best-ranked endpoint whose circuit lets a request
+        through, preferring those not in tried and adding the choice to
+        it, or None if every circuit is open."""
+        ranked = self.host_selector.rank(self.hosts)
+        if tried:
+            ranked = ([host for host in ranked if host not in tried] +
+                      [host for host in ranked if host in tried])
+        for host in ranked:
+            if breaker is None or breaker.allow(host):
+                if tried is not None and host not in tried:
+                    tried.append(host)
+                return host
+        return None
+
+    def _hostUrl(self, url, host):
+        """Return url, resolved against base_url, for another endpoint."""
+        if host == self.host:
+            return url
+        return self._base_urls[host] + url[len(self.base_url):]
+
+    def _sendGet(self, url, path, body, headers, rewind, retry, deadline):
+        """Send a GET through the response cache and the coalescer."""
+        key = self._coalesceKey(url, headers)
+        cache = self.response_cache
+        stale = None
+        if cache is not None:
+            cached, stale, headers = cache.lookup(key, headers)
+            if cached is not None:
+                return cached
+        args = (url, path, "GET", body, headers, rewind, retry, deadline,
+                False)
+        if self.coalescer is not None:
+            r = self.coalescer.do(key, self._send, args, deadline)
+        else:
+            r = self._send(*args)
+        if cache is not None:
+            r = cache.store(key, url, path, r, r.status_code, stale)
+        return r
+
+    def _coalesceKey(self, url, headers):
+        """Return the key under which a GET of url with the prepared headers
+        is coalesced with identical requests."""
+        if headers is self._default_headers:
+            return (self._auth_identity, url, None)
+        return (self._auth_identity, url, tuple(sorted(headers.items())))
+
+    def _send(self, url, path, method, body, headers, rewind, retry,
+              deadline, stream):
+        """Send a prepared request, retrying it as the retry policy asks, and
+        return the final successful response."""
+        exceptions = loadRequests().exceptions
+        call = _Attempts(self, url, path, method, rewind, retry, deadline)
+        while True:
+            wait = call.throttle()
+            if wait:
+                time.sleep(wait)
+            attempt = call.begin()
+            if attempt is None:
+                break
+            target, timeout = attempt
+            r = exc = None
+            attempt_started = monotonic()
+            try:
+                r = self._doRequest(target, method, body, headers, timeout,
+                        stream=bool(stream))
+            except exceptions.Timeout as e:
+                exc = IronTimeoutError("Request to %s timed out: %s" %
+                        (target, e))
+            except exceptions.ConnectionError as e:
+                if isReadTimeout(e):
+                    exc = IronTimeoutError("Request to %s timed out: %s" %
+                            (target, e))
+                else:
+                    exc = e
+            delay = call.finish(r, exc, monotonic() - attempt_started,
+                    None if r is None else r.elapsed.total_seconds())
+            if delay is None:
+                break
+            if delay:
                 time.sleep(delay)
-                delay *= backoff
-                r = self._doRequest(url, method, body, headers)
+            rewind()
 
+        r = call.response
+        if stream and r.status_code >= 400:
+            r.close()
         r.raise_for_status()
+        return r
+
+    def _responseStatus(self, r):
+        return r.status_code
+
+    def _discardResponse(self, r):
+        """Release a response that is not returned because the call is
+        retried."""
+        r.close()
+
+    hook_events = ("before_request", "after_response", "on_retry",
+                   "on_throttle", "on_token_refresh")
+
+    def addHook(self, event, callback):
+        """Call callback with keyword arguments describing every occurrence
+        of event. Callbacks should accept **kwargs so new arguments can be
+        added later.
+
+        Events and their arguments:
+        before_request -- method, url, path, attempt; before each attempt.
+        after_response -- method, url, path, attempt, status, error,
+                          elapsed, server_time, response; after each attempt.
+                          status and response are None if the attempt failed
+                          with error, a connection error or IronTimeoutError.
+                          elapsed is the wall time of the attempt and
+                          server_time the time until the response headers
+                          were parsed.
+        on_retry -- method, url, path, attempt, delay, status, error; when an
+                    attempt is about to be retried after delay seconds.
+        on_throttle -- method, url, path, attempt, delay; when the rate
+                       limiter holds an attempt back for delay seconds.
+        on_token_refresh -- duration, elapsed; when the Keystone token has
+                            been refreshed, with its lifetime and the time
+                            the refresh took.
+        """
+        if event not in self.hook_events:
+            raise ValueError("Unknown hook event: %s" % event)
+        hooks = dict(self._hooks)
+        hooks[event] = hooks.get(event, ()) + (callback,)
+        self._hooks = hooks
 
-        result = {}
-        contentType = r.headers["Content-Type"]
-        if contentType is None:
-            contentType = "text/plain"
+    def removeHook(self, event, callback):
+        """Stop calling callback for event."""
+        hooks = dict(self._hooks)
+        callbacks = tuple(c for c in hooks.get(event, ()) if c != callback)
+        if callbacks:
+            hooks[event] = callbacks
         else:
-            contentType = contentType.split(";")[0]
-        if contentType.lower() == "application/json":
+            hooks.pop(event, None)
+        self._hooks = hooks
+
+    def _emit(self, event, **info):
+        for callback in self._hooks.get(event, ()):
+            callback(client=self, event=event, **info)
+
+    def _tokenRefreshed(self, duration, elapsed):
+        if self._hooks:
+            self._emit("on_token_refresh", duration=duration, elapsed=elapsed)
+
+    # Methods whose bodies are compressed when compression is set.
+    compressed_methods = ("POST", "PUT", "PATCH")
+
+    def _compress(self, body, headers):
+        """Compress a normalized in-memory body of at least
+        compression_threshold bytes, returning it with headers updated to
+        match. Other bodies, and bodies the caller already encoded, are
+        returned unchanged."""
+        if not isinstance(body, (bytes, bytearray, memoryview)) or \
+                bodyLength(body) < self.compression_threshold:
+            return body, headers
+        if any(k.lower() == "content-encoding" for k in headers):
+            return body, headers
+        body = compressBody(body, self.compression, self.compression_level)
+        headers = dict((k, v) for k, v in headers.items()
+                       if k.lower() != "content-length")
+        headers["Content-Encoding"] = self.compression
+        headers["Content-Length"] = str(len(body))
+        return body, headers
+
+    def _encodeJson(self, body, headers):
+        """Serialize a dict or list body with the client's JSON codec and
+        return it with headers declaring it as JSON."""
+        headers = dict(headers)
+        if not any(k.lower() == "content-type" for k in headers):
+            headers["Content-Type"] = "application/json"
+        return self.json_codec.dumps(body), headers
+
+    def _streamBody(self, r, mode):
+        exceptions = loadRequests().exceptions
+        try:
+            if mode == "lines":
+                for line in r.iter_lines(self.stream_chunk_size):
+                    yield line
+            elif mode == "json":
+                for item in iterJsonArray(
+                        r.iter_content(self.stream_chunk_size)):
+                    yield item
+            else:
+                for chunk in r.iter_content(self.stream_chunk_size):
+                    yield chunk
+        except exceptions.Timeout as e:
+            raise IronTimeoutError("Reading %s timed out: %s" % (r.url, e))
+        except exceptions.ConnectionError as e:
+            if not isReadTimeout(e):
+                raise
+            raise IronTimeoutError("Reading %s timed out: %s" % (r.url, e))
+        finally:
+            r.close()
+
+    def _attemptTimeout(self, started, deadline):
+        """Return the requests timeout for the next attempt of a call that
+        started at started, capping both timeouts to what is left of the
+        deadline."""
+        connect, read = self.connect_timeout, self.read_timeout
+        if deadline is not None:
+            remaining = deadline - (monotonic() - started)
+            if remaining <= 0:
+                raise IronTimeoutError("Deadline of %ss exceeded" % deadline)
+            connect = remaining if connect is None else min(connect, remaining)
+            read = remaining if read is None else min(read, remaining)
+        if connect is None and read is None:
+            return None
+        return (connect, read)
+
+    def _reserveRate(self, path, started, deadline):
+        """Take a token from the rate limiter for path and return the seconds
+        to wait before sending. Raises IronTimeoutError if the wait would
+        run past the deadline."""
+        timeout = None
+        if deadline is not None:
+            timeout = max(0.0, deadline - (monotonic() - started))
+        wait = self.rate_limiter.reserve(self.product, self.project_id, path,
+                                         timeout)
+        if wait is None:
+            raise IronTimeoutError("Deadline of %ss exceeded waiting for the "
+                                   "rate limit of %s" % (deadline, path))
+        return wait
+
+    def _retryPolicy(self, retry):
+        if retry is True:
+            return self.retry_policy
+        if not retry:
+            return None
+        return retry
+
+    def request_many(self, requests, max_concurrency=None, retry=True):
+        """Execute many independent HTTP requests concurrently and return a
+        list of their results in the same order as requests.
+
+        Each result is either the dict request() would have returned or the
+        exception it raised, so one failing call does not abort the batch.
+
+        Keyword arguments:
+        requests -- A list of request specs. Each spec is either a
+                    (method, url, body, headers) tuple, where body and
+                    headers may be omitted, or a dict of request() keyword
+                    arguments. Required.
+        max_concurrency -- The maximum number of requests in flight at once.
+                           Defaults to pool_maxsize, so the batch never needs
+                           more connections than the pool keeps.
+        retry -- Whether exponential backoff should be employed, or the
+                 RetryPolicy to use, for specs that do not set it themselves.
+                 Defaults to True.
+        """
+        specs = requestSpecs(requests, retry)
+        if not specs:
+            return []
+
+        def run(kwargs):
             try:
-                result["body"] = json.loads(r.text)
-            except:
-                result["body"] = r.text
+                return self.request(**kwargs)
+            except Exception as e:
+                return e
+
+        from multiprocessing.pool import ThreadPool
+        if max_concurrency is None:
+            max_concurrency = self.pool_maxsize
+        pool = ThreadPool(max(1, min(max_concurrency, len(specs))))
+        try:
+            return pool.map(run, specs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    # Resolved URLs remembered by _prepareRequest before the cache is reset.
+    url_cache_size = 1024
+
+    def _prepareRequest(self, url, headers):
+        """Merge headers with the client defaults and resolve url against
+        base_url, returning the (url, headers) pair to send. Neither the
+        caller's headers nor the defaults are modified; without extra
+        headers the prepared defaults themselves are returned."""
+        if headers:
+            merged = dict(headers)
+            merged.update(self._default_headers)
+            headers = asciiHeaders(merged)
         else:
-            result["body"] = r.text
-        result["status"] = r.status_code
-        result["resp"] = r
-        result["content-type"] = contentType
-        return result
+            headers = self._default_headers
+
+        cache = self._url_cache
+        if self._url_cache_base is not self.base_url:
+            cache = self._url_cache = {}
+            self._url_cache_base = self.base_url
+        full_url = cache.get(url)
+        if full_url is None:
+            full_url = self.base_url + url
+            if not sys.version_info >= (3,):
+                if isinstance(full_url, unicode):
+                    full_url = full_url.encode('ascii')
+            if len(cache) >= self.url_cache_size:
+                cache.clear()
+            cache[url] = full_url
+        return full_url, headers
+
+    def _authorize(self, headers, token):
+        """Return headers with the Authorization header for token added. The
+        header, and the authorized copy of the default headers, are only
+        rebuilt when the token changes."""
+        auth = self._auth
+        if auth is None or auth[0] != token:
+            value = asciiHeaders({"Authorization": "OAuth %s" % token})
+            defaults = dict(self._default_headers)
+            defaults.update(value)
+            auth = self._auth = (token, value, defaults)
+        if headers is self._default_headers:
+            return auth[2]
+        headers = dict(headers)
+        headers.update(auth[1])
+        return headers
 
-    def get(self, url, headers={}, retry=True):
+    def get(self, url, headers={}, retry=True, deadline=None, stream=False,
+            decode=True):
         """Execute an HTTP GET request and return a dict containing the
         response and the response status code.
 
@@ -278,31 +2239,42 @@ class IronClient(object):
                version or project ID, with no leading /. Required.
         headers -- HTTP Headers to send with the request. Can overwrite the
                    defaults. Defaults to {}.
-        retry -- Whether exponential backoff should be employed. Defaults
-                 to True.
+        retry -- Whether exponential backoff should be employed, or the
+                 RetryPolicy to use for this call. Defaults to True.
+        deadline -- Seconds the call may take in total, across all retries.
+                    Defaults to None (no deadline).
+        stream -- Return the body as an iterator instead of reading it all
+                  into memory. See request(). Defaults to False.
+        decode -- Whether to decode the body rather than return the raw
+                  bytes. Defaults to True.
         """
         return self.request(url=url, method="GET", headers=headers,
-                retry=retry)
+                retry=retry, deadline=deadline, stream=stream, decode=decode)
 
-    def post(self, url, body="", headers={}, retry=True):
+    def post(self, url, body="", headers={}, retry=True, deadline=None):
         """Execute an HTTP POST request and return a dict containing the
         response and the response status code.
 
         Keyword arguments:
         url -- The path to execute the result against, not including the API
                version or project ID, with no leading /. Required.
-        body -- A string or file object to send as the body of the request.
+        body -- A string, bytes-like object, file object, generator of byte
+                chunks or MultipartEncoder to send as the body of the
+                request. Text is sent UTF-8 encoded and generators with
+                chunked transfer encoding. A dict or list is sent as JSON.
                 Defaults to an empty string.
         headers -- HTTP Headers to send with the request. Can overwrite the
                    defaults. Defaults to {}.
-        retry -- Whether exponential backoff should be employed. Defaults
-                 to True.
+        retry -- Whether exponential backoff should be employed, or the
+                 RetryPolicy to use for this call. Defaults to True.
+        deadline -- Seconds the call may take in total, across all retries.
+                    Defaults to None (no deadline).
         """
-        headers["Content-Length"] = str(len(body))
+        headers = uploadHeaders(body, headers)
         return self.request(url=url, method="POST", body=body, headers=headers,
-                retry=retry)
+                retry=retry, deadline=deadline)
 
-    def delete(self, url, headers={}, retry=True, body=""):
+    def delete(self, url, headers={}, retry=True, body="", deadline=None):
         """Execute an HTTP DELETE request and return a dict containing the
         response and the response status code.
 
@@ -311,54 +2283,71 @@ class IronClient(object):
                version or project ID, with no leading /. Required.
         headers -- HTTP Headers to send with the request. Can overwrite the
                    defaults. Defaults to an empty dict.
-        retry -- Whether exponential backoff should be employed. Defaults
-                 to True.
-        body -- A string or file object to send as the body of the request.
+        retry -- Whether exponential backoff should be employed, or the
+                 RetryPolicy to use for this call. Defaults to True.
+        body -- A string, bytes-like object, file object, generator of byte
+                chunks or MultipartEncoder to send as the body of the
+                request. Text is sent UTF-8 encoded and generators with
+                chunked transfer encoding. A dict or list is sent as JSON.
                 Defaults to an empty string.
+        deadline -- Seconds the call may take in total, across all retries.
+                    Defaults to None (no deadline).
         """
         return self.request(url=url, method="DELETE", headers=headers,
-                retry=retry, body=body)
+                retry=retry, body=body, deadline=deadline)
 
-    def put(self, url, body="", headers={}, retry=True):
+    def put(self, url, body="", headers={}, retry=True, deadline=None):
         """Execute an HTTP PUT request and return a dict containing the
         response and the response status code.
 
         Keyword arguments:
         url -- The path to execute the result against, not including the API
                version or project ID, with no leading /. Required.
-        body -- A string or file object to send as the body of the request.
+        body -- A string, bytes-like object, file object, generator of byte
+                chunks or MultipartEncoder to send as the body of the
+                request. Text is sent UTF-8 encoded and generators with
+                chunked transfer encoding. A dict or list is sent as JSON.
                 Defaults to an empty string.
         headers -- HTTP Headers to send with the request. Can overwrite the
                 defaults. Defaults to {}.
-        retry -- Whether exponential backoff should be employed. Defaults
-                 to True.
+        retry -- Whether exponential backoff should be employed, or the
+                 RetryPolicy to use for this call. Defaults to True.
+        deadline -- Seconds the call may take in total, across all retries.
+                    Defaults to None (no deadline).
         """
+        headers = uploadHeaders(body, headers)
         return self.request(url=url, method="PUT", body=body, headers=headers,
-                retry=retry)
+                retry=retry, deadline=deadline)
 
-    def patch(self, url, body="", headers={}, retry=True):
+    def patch(self, url, body="", headers={}, retry=True, deadline=None):
         """Execute an HTTP PATCH request and return a dict containing the
         response and the response status code.
 
         Keyword arguments:
         url -- The path to execute the result against, not including the API
                version or project ID, with no leading /. Required.
-        body -- A string or file object to send as the body of the request.
+        body -- A string, bytes-like object, file object, generator of byte
+                chunks or MultipartEncoder to send as the body of the
+                request. Text is sent UTF-8 encoded and generators with
+                chunked transfer encoding. A dict or list is sent as JSON.
                 Defaults to an empty string.
         headers -- HTTP Headers to send with the request. Can overwrite the
                 defaults. Defaults to {}.
-        retry -- Whether exponential backoff should be employed. Defaults
-                 to True.
+        retry -- Whether exponential backoff should be employed, or the
+                 RetryPolicy to use for this call. Defaults to True.
+        deadline -- Seconds the call may take in total, across all retries.
+                    Defaults to None (no deadline).
         """
+        headers = uploadHeaders(body, headers)
         return self.request(url=url, method="PATCH", body=body, headers=headers,
-                retry=retry)
+                retry=retry, deadline=deadline)
 
     @staticmethod
     def fromRfc3339(timestamp=None):
         if timestamp is None:
             timestamp = datetime.now()
             return timestamp
-        return dateutil.parser.parse(timestamp)
+        return parseRfc3339(timestamp)
 
     @staticmethod
     def toRfc3339(timestamp=None):
@@ -373,18 +2362,728 @@ class IronClient(object):
             return timestamp
         return datetime.fromtimestamp(float(timestamp))
 
-def configFromFile(config, path, product=None):
-    if path is None:
-        return config
-    if not os.path.exists(path):
-        return config
+
+class AutoBatcher(object):
+    """Collect small items posted to the same endpoint and send them
+    together in one request.
+
+    submit() adds an item to the batch for its path and returns a
+    concurrent.futures.Future. A batch is sent once it holds max_items
+    items or its first item has waited max_delay seconds, as one POST
+    whose body is {body_key: [items]}, and each future then receives the
+    result for its item, taken from the list under result_key in the
+    response body, or the error that failed the request. The defaults fit
+    IronMQ messages:
+
+        batcher = AutoBatcher(client)
+        future = batcher.submit("queues/q/messages", {"body": "hello"})
+        message_id = future.result()
+
+    For IronWorker tasks use body_key="tasks" and result_key="tasks". A
+    batcher may be used from many threads; close() it, or use it as a
+    context manager, to send what is left.
+    """
+
+    def __init__(self, client, max_items=100, max_delay=.01,
+                 body_key="messages", result_key="ids", max_concurrency=4):
+        """Create a batcher.
+
+        Keyword arguments:
+        client -- The IronClient batches are posted with. Required.
+        max_items -- The most items sent in one request. Defaults to 100,
+                     the IronMQ limit.
+        max_delay -- The most seconds an item waits for others to join its
+                     batch. Defaults to .01.
+        body_key -- The request body key holding the list of items.
+                    Defaults to "messages".
+        result_key -- The response body key holding the list of per-item
+                      results, in the order of the items. Defaults to
+                      "ids".
+        max_concurrency -- The most batches sent at the same time. Defaults
+                           to 4.
+        """
+        from concurrent.futures import Future, ThreadPoolExecutor
+        self._future = Future
+        self.client = client
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.body_key = body_key
+        self.result_key = result_key
+        self.batches = 0
+        self.items = 0
+        self._executor_class = ThreadPoolExecutor
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_concurrency)
+        self._pending = {}
+        self._sending = set()
+        self._closed = False
+        self._thread = None
+        self._condition = threading.Condition()
+        forkSafe(self)
+
+    def _afterFork(self):
+        # Pending items belong to the parent, which sends them; the flush
+        # thread and the executor's workers do not exist in the child.
+        self._pending = {}
+        self._sending = set()
+        self._thread = None
+        self._condition = threading.Condition()
+        self._executor = self._executor_class(self.max_concurrency)
+
+    def submit(self, path, item):
+        """Queue item to be posted to path and return a Future for its
+        result."""
+        if checkFork is not None:
+            checkFork()
+        future = self._future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("AutoBatcher is closed")
+            batch = self._pending.get(path)
+            if batch is None:
+                batch = self._pending[path] = {"items": [], "futures": [],
+                                               "started": monotonic()}
+            batch["items"].append(item)
+            batch["futures"].append(future)
+            if len(batch["items"]) >= self.max_items:
+                del self._pending[path]
+                self._dispatch(path, batch)
+            elif len(batch["items"]) == 1:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run)
+                    self._thread.daemon = True
+                    self._thread.start()
+                self._condition.notify()
+        return future
+
+    def flush(self):
+        """Send every pending batch now and wait until all batches sent so
+        far have completed."""
+        with self._condition:
+            for path, batch in list(self._pending.items()):
+                self._dispatch(path, batch)
+            self._pending.clear()
+            sending = list(self._sending)
+        for task in sending:
+            task.exception()
+
+    def close(self):
+        """Send what is pending and stop accepting items."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self.flush()
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self):
+        with self._condition:
+            while not self._closed:
+                if not self._pending:
+                    self._condition.wait()
+                    continue
+                now = monotonic()
+                wake = None
+                for path, batch in list(self._pending.items()):
+                    due = batch["started"] + self.max_delay
+                    if due <= now:
+                        del self._pending[path]
+                        self._dispatch(path, batch)
+                    elif wake is None or due < wake:
+                        wake = due
+                if wake is not None:
+                    self._condition.wait(wake - now)
+
+    def _dispatch(self, path, batch):
+        # Called with the condition held.
+        task = self._executor.submit(self._send, path, batch["items"],
+                                     batch["futures"])
+        self._sending.add(task)
+        task.add_done_callback(self._sent)
+
+    def _sent(self, task):
+        with self._condition:
+            self._sending.discard(task)
+
+    def _send(self, path, items, futures):
+        live = [(item, future) for item, future in zip(items, futures)
+                if future.set_running_or_notify_cancel()]
+        if not live:
+            return
+        items = [item for item, future in live]
+        try:
+            result = self.client.post(path, body={self.body_key: items})
+            body = result["body"]
+            values = body.get(self.result_key) \
+                if isinstance(body, dict) else None
+            if not isinstance(values, list) or len(values) != len(items):
+                raise ValueError("Expected %d results under %r in the "
+                                 "response, got %r" % (len(items),
+                                                       self.result_key, body))
+        except Exception as e:
+            for item, future in live:
+                future.set_exception(e)
+            return
+        with self._condition:
+            self.batches += 1
+            self.items += len(items)
+        for (item, future), value in zip(live, values):
+            future.set_result(value)
+
+@contextlib.contextmanager
+def lockedFile(path, timeout=None):
+    """Open path for reading and writing, creating it readable only by its
+    owner, and hold an exclusive lock on it until the block exits. Yields
+    the file descriptor, or None if timeout seconds passed without getting
+    the lock. Locking is skipped where fcntl is unavailable."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if hasattr(os, "fchmod"):
+            os.fchmod(fd, 0o600)
+        if fcntl is not None:
+            if timeout is None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                give_up_at = monotonic() + timeout
+                while True:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except (IOError, OSError) as e:
+                        if e.errno not in (errno.EAGAIN, errno.EACCES):
+                            raise
+                    if monotonic() >= give_up_at:
+                        yield None
+                        return
+                    time.sleep(.05)
+        yield fd
+    finally:
+        # Closing the descriptor releases the lock.
+        os.close(fd)
+
+
+def readFile(fd):
+    """Read the whole content of an open file descriptor."""
+    os.lseek(fd, 0, os.SEEK_SET)
+    chunks = []
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+def writeFile(fd, data):
+    """Replace the whole content of an open file descriptor with data."""
+    os.lseek(fd, 0, os.SEEK_SET)
+    os.ftruncate(fd, 0)
+    while data:
+        data = data[os.write(fd, data):]
+
+
+try:
+    from datetime import timezone
+
+    def fixedOffset(minutes):
+        return timezone(timedelta(minutes=minutes))
+except ImportError:
+    class FixedOffset(tzinfo):
+        """A constant offset from UTC, for Pythons without
+        datetime.timezone."""
+
+        def __init__(self, minutes):
+            self._offset = timedelta(minutes=minutes)
+
+        def utcoffset(self, dt):
+            return self._offset
+
+        def dst(self, dt):
+            return timedelta(0)
+
+        def tzname(self, dt):
+            return None
+
+    fixedOffset = FixedOffset
+
+_offsets = {}
+_rfc3339 = re.compile(r"(\d{4})-(\d\d)-(\d\d)[Tt ](\d\d):(\d\d):(\d\d)"
+                      r"(?:\.(\d+))?(?:([Zz])|([+-])(\d\d):?(\d\d))?$")
+
+
+def parseRfc3339(timestamp):
+    """Parse an RFC 3339 timestamp such as 2014-01-01T10:00:00.000000Z into a
+    datetime, timezone aware when the timestamp has an offset. Formats the
+    fast path does not recognise are handed to dateutil."""
+    match = _rfc3339.match(timestamp)
+    if match is None:
+        global dateutil
+        if dateutil is None:
+            import dateutil.parser
+        return dateutil.parser.parse(timestamp)
+
+    (year, month, day, hour, minute, second, fraction, utc, sign, offset_hours,
+     offset_minutes) = match.groups()
+    if utc:
+        minutes = 0
+    elif sign:
+        minutes = int(offset_hours) * 60 + int(offset_minutes)
+        if sign == "-":
+            minutes = -minutes
+    else:
+        minutes = None
+    tz = None
+    if minutes is not None:
+        tz = _offsets.get(minutes)
+        if tz is None:
+            tz = _offsets.setdefault(minutes, fixedOffset(minutes))
+    microsecond = int((fraction or "0")[:6].ljust(6, "0"))
+    return datetime(int(year), int(month), int(day), int(hour), int(minute),
+                    int(second), microsecond, tz)
+
+
+def parseRetryAfter(value):
+    """Return the number of seconds a Retry-After header value asks to wait,
+    or None if it cannot be parsed."""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    import email.utils
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+
+
+class MultipartEncoder(object):
+    """A multipart/form-data body that is streamed from its parts as it is
+    sent instead of being assembled in memory, for uploading large code
+    packages.
+
+    Pass it as the body of IronClient.post or put; the Content-Type header,
+    including the boundary, is filled in from content_type.
+    """
+
+    # Part types sent from memory rather than read like files.
+    _buffers = (bytes, bytearray, memoryview)
+
+    def __init__(self, fields, boundary=None):
+        """Create an encoder.
+
+        Keyword arguments:
+        fields -- A dict or list of (name, value) pairs. A value is either a
+                  string or bytes-like object, or a (filename, data,
+                  content_type) tuple where data is bytes-like or a file
+                  object to stream from.
+                  Required.
+        boundary -- The multipart boundary. Defaults to a random one.
+        """
+        if boundary is None:
+            import uuid
+            boundary = uuid.uuid4().hex
+        self.boundary = boundary
+        self.content_type = "multipart/form-data; boundary=%s" % self.boundary
+        if isinstance(fields, dict):
+            fields = fields.items()
+        self._parts = []
+        for name, value in fields:
+            if isinstance(value, tuple):
+                filename, data, content_type = value
+                header = ('--%s\r\nContent-Disposition: form-data; '
+                          'name="%s"; filename="%s"\r\n'
+                          'Content-Type: %s\r\n\r\n' % (self.boundary, name,
+                                                         filename, content_type))
+            else:
+                data = value
+                header = ('--%s\r\nContent-Disposition: form-data; '
+                          'name="%s"\r\n\r\n' % (self.boundary, name))
+            self._parts.append(header.encode("utf-8"))
+            self._parts.append(encodeBody(data))
+            self._parts.append(b"\r\n")
+        self._parts.append(("--%s--\r\n" % self.boundary).encode("utf-8"))
+
+        self._starts = [None if isinstance(part, self._buffers) else
+                        part.tell() for part in self._parts]
+        self._length = sum(bodyLength(part) for part in self._parts)
+        self._index = 0
+        self._offset = 0
+        self._position = 0
+
+    def __len__(self):
+        return self._length
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position):
+        """Rewind to position, which must be 0, so the body can be resent."""
+        if position != 0:
+            raise ValueError("MultipartEncoder can only seek to 0")
+        for part, start in zip(self._parts, self._starts):
+            if start is not None:
+                part.seek(start)
+        self._index = self._offset = self._position = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length - self._position
+        out = []
+        while size > 0 and self._index < len(self._parts):
+            part = self._parts[self._index]
+            if isinstance(part, self._buffers):
+                data = bytes(part[self._offset:self._offset + size])
+                self._offset += len(data)
+                if self._offset >= bodyLength(part):
+                    self._index += 1
+                    self._offset = 0
+            else:
+                data = part.read(size)
+                if not data:
+                    self._index += 1
+                    continue
+            out.append(data)
+            size -= len(data)
+        data = b"".join(out)
+        self._position += len(data)
+        return data
+
+
+def compressBody(data, encoding, level=6):
+    """Compress data for the "gzip" or "deflate" HTTP content encoding."""
+    wbits = 31 if encoding == "gzip" else 15
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    return compressor.compress(data) + compressor.flush()
+
+
+def encodeBody(body):
+    """Normalize a request body for sending: text is UTF-8 encoded and
+    memoryviews are cast to flat bytes, without copying their data."""
+    if body is None:
+        return b""
+    if isinstance(body, type(u"")):
+        return body.encode("utf-8")
+    if isinstance(body, memoryview) and body.format != "B":
+        return body.cast("B")
+    return body
+
+
+def bodyLength(body):
+    """Return the number of bytes a normalized body will send, or None if
+    that can only be known by consuming it, as with generators."""
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    if isinstance(body, memoryview):
+        return body.nbytes
+    if hasattr(body, "read"):
+        if hasattr(body, "__len__"):
+            return len(body) - body.tell()
+        try:
+            return os.fstat(body.fileno()).st_size - body.tell()
+        except (AttributeError, OSError, IOError, ValueError):
+            pass
+        try:
+            position = body.tell()
+            body.seek(0, os.SEEK_END)
+            length = body.tell() - position
+            body.seek(position)
+            return length
+        except (AttributeError, OSError, IOError, ValueError):
+            return None
+    return None
+
+
+def iterFile(file, chunk_size):
+    """Yield the content of a file object chunk_size bytes at a time."""
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def isReadTimeout(error):
+    """Return whether a requests ConnectionError is a read timeout, which
+    requests raises as one when the body stalls after the headers
+    arrived."""
+    try:
+        from urllib3.exceptions import ReadTimeoutError
+    except ImportError:
+        from requests.packages.urllib3.exceptions import ReadTimeoutError
+    return any(isinstance(arg, (ReadTimeoutError, socket.timeout))
+               for arg in error.args)
+
+
+def bodyRewinder(body):
+    """Return a function that rewinds a normalized body so it can be sent
+    again on a retry, or None if it is a one-shot iterator."""
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        return lambda: None
+    if hasattr(body, "read"):
+        try:
+            position = body.tell()
+        except (AttributeError, OSError, IOError):
+            return None
+        return lambda: body.seek(position)
+    if hasattr(body, "__iter__") and not isinstance(body, (list, tuple, dict)):
+        return None
+    return lambda: None
+
+
+def requestSpecs(requests, retry):
+    """Return the request() keyword arguments of each request_many spec."""
+    specs = []
+    for spec in requests:
+        if isinstance(spec, dict):
+            kwargs = dict(spec)
+        else:
+            kwargs = dict(zip(("method", "url", "body", "headers"), spec))
+        kwargs.setdefault("retry", retry)
+        specs.append(kwargs)
+    return specs
+
+
+def uploadHeaders(body, headers):
+    """Return a copy of headers with the Content-Length of body and, for
+    multipart bodies, the Content-Type. Bodies of unknown length are sent
+    with chunked transfer encoding instead."""
+    headers = dict(headers)
+    length = bodyLength(encodeBody(body))
+    if length is not None:
+        headers["Content-Length"] = str(length)
+    if isinstance(body, MultipartEncoder) and "Content-Type" not in headers:
+        headers["Content-Type"] = body.content_type
+    return headers
+
+
+def iterJsonArray(chunks):
+    """Incrementally decode a JSON array from an iterable of UTF-8 encoded
+    byte chunks, yielding its items one at a time without holding the whole
+    document in memory."""
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    whitespace = " \t\r\n"
+    buf = ""
+    started = False
+    expect_item = True
+    chunks = iter(chunks)
+    final = False
+    while not final:
+        try:
+            buf += text_decoder.decode(next(chunks))
+        except StopIteration:
+            buf += text_decoder.decode(b"", final=True)
+            final = True
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in whitespace:
+                pos += 1
+            if pos == len(buf):
+                break
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError("JSON body is not an array")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                return
+            if not expect_item:
+                if buf[pos] != ",":
+                    raise ValueError("Expected ',' at %r" % buf[pos:pos + 20])
+                expect_item = True
+                pos += 1
+                continue
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if final:
+                    raise
+                break
+            # A number cut off by the end of the chunk ("1" of "1.5") decodes
+            # fine on its own, so only trust a value followed by a delimiter.
+            if not final and (end == len(buf) or
+                              buf[end] not in whitespace + ",]"):
+                break
+            yield item
+            expect_item = False
+            pos = end
+        buf = buf[pos:]
+    raise ValueError("Incomplete JSON array")
+
+
+def decodeBody(contentType, content, text, codec=None):
+    """Return the (content type, body) pair for a response, parsing the raw
+    content bytes with codec when the content type says it is JSON, and
+    falling back to the text() of the response otherwise."""
+    if contentType is None:
+        contentType = "text/plain"
+    else:
+        contentType = contentType.split(";")[0]
+    if contentType.lower() == "application/json":
+        if codec is None:
+            codec = findJsonCodec()
+        try:
+            return contentType, codec.loads(content)
+        except ValueError:
+            return contentType, text()
+    return contentType, text()
+
+
+default_config = {
+        "host": None,
+        "protocol": "https",
+        "port": 443,
+        "api_version": None,
+        "project_id": None,
+        "token": None,
+        "keystone": None,
+        "path_prefix": None,
+        "cloud": None,
+        "pool_connections": 10,
+        "pool_maxsize": 10,
+        "pool_idle_timeout": None,
+        "pool_block": False,
+        "connect_timeout": None,
+        "read_timeout": None,
+        "compression": None,
+        "compression_threshold": 1024,
+        "compression_level": 6,
+        "transport": "requests",
+}
+
+products = {
+        "iron_worker": {
+            "host": "worker-aws-us-east-1.iron.io",
+            "version": 2
+        },
+        "iron_mq": {
+            "host": "mq-aws-us-east-1-1.iron.io",
+            "version": 3
+        },
+        "iron_cache": {
+            "host": "cache-aws-us-east-1.iron.io",
+            "version": 1
+        }
+}
+
+_config_lock = threading.Lock()
+_config_files = {}
+_config_env = {}
+_resolved_configs = {}
+
+
+def invalidateConfigCache():
+    """Forget all cached config files, environment variables and resolved
+    configurations, so the next resolution reads them again. Call it after
+    changing IRON_* environment variables at runtime."""
+    with _config_lock:
+        _config_files.clear()
+        _config_env.clear()
+        _resolved_configs.clear()
+
+
+def fileStamp(path):
+    """Return a value that changes whenever the file at path does, or None if
+    it does not exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, getattr(st, "st_mtime_ns", None), st.st_size,
+            st.st_ino)
+
+
+def settledStamp(stamp):
+    """Return True if a file with this stamp was last modified long enough
+    ago that a later write within the same timestamp tick cannot go
+    unnoticed. Recently modified files are not cached."""
+    return stamp is None or time.time() - stamp[0] > 2
+
+
+def loadConfigFile(path):
+    """Return the parsed content of the JSON config file at path, or None if
+    it does not exist or cannot be read. Parsed files are cached until
+    their modification time or size changes."""
+    path = os.path.abspath(path)
+    stamp = fileStamp(path)
+    if stamp is None:
+        return None
+    cached = _config_files.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
     try:
         file = open(path, "r")
     except IOError:
-        return config
+        return None
 
     raw = json.loads(file.read())
     file.close()
+    if settledStamp(stamp):
+        with _config_lock:
+            _config_files[path] = (stamp, raw)
+    return raw
+
+
+def environValue(name):
+    """Return the environment variable name, or None if it is not set. The
+    environment is only read once per variable until
+    invalidateConfigCache() is called."""
+    try:
+        return _config_env[name]
+    except KeyError:
+        value = os.environ.get(name)
+        with _config_lock:
+            _config_env[name] = value
+        return value
+
+
+def resolveConfig(product, config_file=None, **kwargs):
+    """Resolve the configuration of a client for product and return it as a
+    new dict.
+
+    Settings are layered from the built-in defaults, ~/.iron.json, the
+    IRON_* and product environment variables, ./iron.json, config_file and
+    finally the non-None keyword arguments. Everything but the keyword
+    arguments is cached and shared between calls until one of the files
+    changes or invalidateConfigCache() is called.
+    """
+    paths = (os.path.expanduser("~/.iron.json"), os.path.abspath("iron.json"),
+             os.path.abspath(config_file) if config_file else None)
+    stamps = tuple(fileStamp(path) if path else None for path in paths)
+    key = (product, paths)
+    cached = _resolved_configs.get(key)
+    if cached is None or cached[0] != stamps:
+        config = dict(default_config)
+        if product in products:
+            config["host"] = products[product]["host"]
+            config["api_version"] = products[product]["version"]
+
+        try:
+            config = configFromFile(config, paths[0], product)
+        except:
+            pass
+        config = configFromEnv(config)
+        config = configFromEnv(config, product)
+        config = configFromFile(config, paths[1], product)
+        config = configFromFile(config, paths[2], product)
+        cached = (stamps, config)
+        if all(settledStamp(stamp) for stamp in stamps):
+            with _config_lock:
+                _resolved_configs[key] = cached
+    return configFromArgs(dict(cached[1]), **kwargs)
+
+
+def configFromFile(config, path, product=None):
+    if path is None:
+        return config
+    raw = loadConfigFile(path)
+    if raw is None:
+        return config
 
     for k in raw.keys():
         if k in config:
@@ -400,9 +3099,9 @@ def configFromEnv(config, product=None):
     if product is None:
         product = "iron"
     for k in config.keys():
-        key = "%s_%s" % (product, k)
-        if key.upper() in os.environ:
-            config[k] = os.environ[key.upper()]
+        value = environValue(("%s_%s" % (product, k)).upper())
+        if value is not None:
+            config[k] = value
     return config
 
 
@@ -412,5 +3111,32 @@ def configFromArgs(config, **kwargs):
             config[k] = kwargs[k]
     return config
 
+readOnlyView = getattr(types, "MappingProxyType", dict)
+
+
+def asciiHeaders(headers):
+    """On Python 2, encode unicode header names and values to ASCII byte
+    strings as httplib expects; elsewhere return headers unchanged."""
+    if sys.version_info >= (3,):
+        return headers
+    return dict((k.encode('ascii') if isinstance(k, unicode) else k,
+                 v.encode('ascii') if isinstance(v, unicode) else v)
+                for k, v in headers.items())
+
+
+def optionalFloat(value):
+    """Convert a config value that may come from the environment as a string
+    to a float, leaving None alone."""
+    if value is None:
+        return None
+    return float(value)
+
+def configFlag(value):
+    """Convert a config value that may come from the environment as a string
+    to a bool."""
+    if hasattr(value, "lower"):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
 def intersect(a, b):
     return list(set(a) & set(b))
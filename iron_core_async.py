@@ -0,0 +1,276 @@
+import asyncio
+import io
+
+import aiohttp
+
+from iron_core import (IronClient, IronTokenProvider, IronTimeoutError,
+        IronResponse, _Attempts, bodyRewinder, checkFork, decodeBody,
+        encodeBody, iterFile, monotonic, requestSpecs, uploadHeaders)
+
+
+async def asyncChunks(chunks):
+    """Yield the chunks of a sync iterable from an async generator."""
+    for chunk in chunks:
+        yield chunk
+
+
+def streamableBody(body):
+    """Return a normalized body in a form aiohttp can send. Bytes-like
+    objects and real files are sent as they are; other file-like objects,
+    such as MultipartEncoder, and generators are streamed from an async
+    generator."""
+    if isinstance(body, (bytes, bytearray, memoryview, io.IOBase)):
+        return body
+    if hasattr(body, "read"):
+        return asyncChunks(iterFile(body, 65536))
+    return asyncChunks(body)
+
+
+class AsyncIronClient(IronClient):
+    """An asyncio flavour of IronClient.
+
+    Configuration is resolved exactly like IronClient (config files,
+    environment and constructor arguments), and the request methods return
+    the same result dict, but they are coroutines that share one
+    non-blocking aiohttp connection pool. The pool is opened on first use
+    from inside the running event loop and should be released with
+    `await client.close()` or `async with client:`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        IronClient.__init__(self, *args, **kwargs)
+        self._inflight = {}
+
+    def _afterFork(self):
+        IronClient._afterFork(self)
+        self._inflight = {}
+
+    def _newSession(self):
+        connector = aiohttp.TCPConnector(
+                limit=self.pool_connections * self.pool_maxsize,
+                limit_per_host=self.pool_maxsize,
+                keepalive_timeout=self.pool_idle_timeout or 15)
+        return aiohttp.ClientSession(connector=connector)
+
+    def _getSession(self):
+        if self._session is None or self._session.closed:
+            self._session = self._newSession()
+        return self._session
+
+    async def close(self):
+        """Close all pooled connections held by the client."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def __enter__(self):
+        raise TypeError("AsyncIronClient must be used with 'async with'")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _getToken(self):
+        if isinstance(self.token_provider, IronTokenProvider):
+            return self.token_provider.getToken()
+        # Keystone may need a blocking round-trip to refresh its token.
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.token_provider.getToken)
+
+    async def _doRequest(self, url, method, body="", headers={},
+                         timeout=None):
+        if self.token or self.keystone:
+            headers = self._authorize(headers, await self._getToken())
+
+        if method not in ("GET", "POST", "PUT", "DELETE", "PATCH"):
+            raise ValueError("Invalid HTTP method")
+        if method == "GET":
+            body = None
+        elif body is not None:
+            body = streamableBody(body)
+        if timeout is not None:
+            connect, read = timeout
+            timeout = aiohttp.ClientTimeout(sock_connect=connect,
+                    sock_read=read)
+        return await self._getSession().request(method, url, data=body,
+                headers=headers, timeout=timeout)
+
+    async def request(self, url, method, body="", headers={}, retry=True,
+                      deadline=None, decode=True):
+        """Execute an HTTP request and return a dict containing the response
+        and the response status code. Takes the same arguments as
+        IronClient.request."""
+        if checkFork is not None:
+            checkFork()
+        path = url
+        url, headers = self._prepareRequest(url, headers)
+        if isinstance(body, (dict, list)):
+            body, headers = self._encodeJson(body, headers)
+        body = encodeBody(body)
+        if self.compression is not None and \
+                method in self.compressed_methods:
+            body, headers = self._compress(body, headers)
+        rewind = bodyRewinder(body)
+
+        cache = self.response_cache
+        if method == "GET" and \
+                (cache is not None or self.coalescer is not None):
+            r = await self._sendGet(url, path, body, headers, rewind, retry,
+                    deadline)
+        elif cache is not None:
+            try:
+                r = await self._send(url, path, method, body, headers,
+                        rewind, retry, deadline)
+            finally:
+                cache.invalidate(url)
+        else:
+            r = await self._send(url, path, method, body, headers, rewind,
+                    retry, deadline)
+
+        content = await r.read()
+        contentType = (r.headers.get("Content-Type") or
+                "text/plain").split(";")[0]
+        if decode:
+            body = decodeBody(contentType, content,
+                    lambda: content.decode(r.get_encoding()),
+                    self.json_codec)[1]
+        else:
+            body = content
+        result = IronResponse(r, r.status, contentType, body=body,
+                loaded=True)
+        if not self.keep_response:
+            result.release()
+        return result
+
+    async def _send(self, url, path, method, body, headers, rewind, retry,
+                    deadline):
+        """Send a prepared request, retrying it as the retry policy asks, and
+        return the final successful response."""
+        call = _Attempts(self, url, path, method, rewind, retry, deadline)
+        while True:
+            wait = call.throttle()
+            if wait:
+                await asyncio.sleep(wait)
+            attempt = call.begin()
+            if attempt is None:
+                break
+            target, timeout = attempt
+            r = exc = server_time = None
+            attempt_started = monotonic()
+            try:
+                r = await self._doRequest(target, method, body, headers,
+                        timeout)
+                server_time = monotonic() - attempt_started
+                await r.read()
+            except asyncio.TimeoutError:
+                r, exc = None, IronTimeoutError(
+                        "Request to %s timed out" % target)
+            except aiohttp.ClientConnectionError as e:
+                r, exc = None, e
+            delay = call.finish(r, exc, monotonic() - attempt_started,
+                    server_time)
+            if delay is None:
+                break
+            if delay:
+                await asyncio.sleep(delay)
+            rewind()
+
+        r = call.response
+        r.raise_for_status()
+        return r
+
+    def _responseStatus(self, r):
+        return r.status
+
+    def _discardResponse(self, r):
+        r.release()
+
+    async def _sendGet(self, url, path, body, headers, rewind, retry,
+                       deadline):
+        """Send a GET through the response cache and the coalescer."""
+        key = self._coalesceKey(url, headers)
+        cache = self.response_cache
+        stale = None
+        if cache is not None:
+            cached, stale, headers = cache.lookup(key, headers)
+            if cached is not None:
+                return cached
+        args = (url, path, "GET", body, headers, rewind, retry, deadline)
+        if self.coalescer is not None:
+            r = await self._coalesce(key, args, deadline)
+        else:
+            r = await self._send(*args)
+        if cache is not None:
+            r = cache.store(key, url, path, r, r.status, stale)
+        return r
+
+    async def _coalesce(self, key, args, deadline):
+        """Return the response of the identical GET already in flight on
+        this client, or send it. Coalescing is per client since the
+        in-flight calls belong to its event loop."""
+        future = self._inflight.get(key)
+        if future is None:
+            future = self._inflight[key] = asyncio.ensure_future(
+                    self._send(*args))
+            future.add_done_callback(lambda f: self._inflight.pop(key, None))
+        else:
+            self.coalescer.shared += 1
+        try:
+            # Shielded so a cancelled caller does not cancel the others.
+            return await asyncio.wait_for(asyncio.shield(future), deadline)
+        except asyncio.TimeoutError:
+            raise IronTimeoutError("Deadline of %ss exceeded for %s" %
+                    (deadline, args[0]))
+
+    async def request_many(self, requests, max_concurrency=None,
+                           retry=True):
+        """Execute many independent HTTP requests concurrently and return a
+        list of their results in the same order as requests. Takes the same
+        arguments as IronClient.request_many."""
+        specs = requestSpecs(requests, retry)
+        if max_concurrency is None:
+            max_concurrency = self.pool_maxsize
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+        async def run(kwargs):
+            async with semaphore:
+                try:
+                    return await self.request(**kwargs)
+                except Exception as e:
+                    return e
+        return list(await asyncio.gather(*[run(kwargs) for kwargs in specs]))
+
+    async def get(self, url, headers={}, retry=True,
+                  deadline=None, decode=True):
+        """Execute an HTTP GET request. See IronClient.get."""
+        return await self.request(url=url, method="GET", headers=headers,
+                retry=retry, deadline=deadline, decode=decode)
+
+    async def post(self, url, body="", headers={}, retry=True,
+                   deadline=None):
+        """Execute an HTTP POST request. See IronClient.post."""
+        headers = uploadHeaders(body, headers)
+        return await self.request(url=url, method="POST", body=body,
+                headers=headers, retry=retry, deadline=deadline)
+
+    async def delete(self, url, headers={}, retry=True, body="",
+                     deadline=None):
+        """Execute an HTTP DELETE request. See IronClient.delete."""
+        return await self.request(url=url, method="DELETE", headers=headers,
+                retry=retry, body=body, deadline=deadline)
+
+    async def put(self, url, body="", headers={}, retry=True,
+                  deadline=None):
+        """Execute an HTTP PUT request. See IronClient.put."""
+        headers = uploadHeaders(body, headers)
+        return await self.request(url=url, method="PUT", body=body,
+                headers=headers, retry=retry, deadline=deadline)
+
+    async def patch(self, url, body="", headers={}, retry=True,
+                    deadline=None):
+        """Execute an HTTP PATCH request. See IronClient.patch."""
+        headers = uploadHeaders(body, headers)
+        return await self.request(url=url, method="PATCH", body=body,
+                headers=headers, retry=retry, deadline=deadline)
@@ -3,8 +3,9 @@ import sys
 
 setup(
         name = "iron-core",
-        py_modules = ["iron_core"],
+        py_modules = ["iron_core", "iron_core_async"],
         install_requires=["requests >= 1.1.0", "python-dateutil"],
+        extras_require={"async": ["aiohttp"], "http2": ["httpx[http2]"]},
         version = "1.2.0",
         description = "Universal classes and methods for Iron.io API wrappers to build on.",
         author = "Iron.io",
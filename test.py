@@ -1,6 +1,16 @@
 import iron_core
 import unittest
 import os
+import sys
+import subprocess
+import tempfile
+import shutil
+import socket
+import threading
+import io
+import zlib
+import time
+import requests
 from iron_core import KeystoneTokenProvider
 
 try:
@@ -8,6 +18,89 @@ try:
 except:
     import simplejson as json
 
+try:
+    import asyncio
+    import iron_core_async
+except (ImportError, SyntaxError):
+    iron_core_async = None
+
+try:
+    import httpx
+    import h2.config
+    import h2.connection
+    import h2.events
+except ImportError:
+    httpx = None
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def _respond(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+                if not size:
+                    break
+        else:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+        self.body = body
+        self.server.requests.append((self.command, self.path,
+                dict(self.headers.items()), body))
+        status, headers, payload = self.server.responder(self)
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_PATCH = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, responder=None):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), MockHandler)
+        self.connections = 0
+        self.requests = []
+        self.responder = responder or (lambda handler: (200,
+                {"Content-Type": "application/json"}, b'{"ok": true}'))
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def client(self, **kwargs):
+        kwargs.setdefault("token", "TEST")
+        return iron_core.IronClient(name="Test", version="0.1.0",
+                product="iron_worker", project_id="TEST2",
+                protocol="http", host="127.0.0.1",
+                port=self.server_address[1], **kwargs)
+
 class TestConfig(unittest.TestCase):
     def setUp(self):
         # Backup their ~/.iron.json file if it exists
@@ -258,6 +351,1716 @@ class TestConfig(unittest.TestCase):
         keystone = KeystoneTokenProvider(keystone_data)
         self.assertEqual("http://localhost/", keystone.server)
 
+class TestConfigCache(unittest.TestCase):
+    def setUp(self):
+        iron_core.invalidateConfigCache()
+        create_test_config("test_cache_config.json",
+                {"project_id": "first", "token": "TEST"})
+        self.age("test_cache_config.json")
+
+    def tearDown(self):
+        remove_test_config("test_cache_config.json")
+        iron_core.invalidateConfigCache()
+
+    def age(self, path, seconds=60):
+        stamp = time.time() - seconds
+        os.utime(path, (stamp, stamp))
+
+    def test_fileCached(self):
+        first = iron_core.loadConfigFile("test_cache_config.json")
+        self.assertTrue(iron_core.loadConfigFile("test_cache_config.json")
+                is first)
+
+    def test_fileChanged(self):
+        config = iron_core.resolveConfig("iron_worker",
+                "test_cache_config.json")
+        self.assertEqual(config["project_id"], "first")
+        create_test_config("test_cache_config.json",
+                {"project_id": "second", "token": "TEST"})
+        self.age("test_cache_config.json", 30)
+        config = iron_core.resolveConfig("iron_worker",
+                "test_cache_config.json")
+        self.assertEqual(config["project_id"], "second")
+
+    def test_recentFileNotCached(self):
+        create_test_config("test_cache_config.json",
+                {"project_id": "second", "token": "TEST"})
+        iron_core.resolveConfig("iron_worker", "test_cache_config.json")
+        self.assertEqual(iron_core._resolved_configs, {})
+
+    def test_environment(self):
+        iron_core.resolveConfig("iron_worker", "test_cache_config.json")
+        os.environ["IRON_WORKER_PORT"] = "8080"
+        try:
+            config = iron_core.resolveConfig("iron_worker",
+                    "test_cache_config.json")
+            self.assertEqual(config["port"], 443)
+            iron_core.invalidateConfigCache()
+            config = iron_core.resolveConfig("iron_worker",
+                    "test_cache_config.json")
+            self.assertEqual(config["port"], "8080")
+        finally:
+            del os.environ["IRON_WORKER_PORT"]
+
+    def test_copies(self):
+        config = iron_core.resolveConfig("iron_worker",
+                "test_cache_config.json", project_id="mine")
+        self.assertEqual(config["project_id"], "mine")
+        config = iron_core.resolveConfig("iron_worker",
+                "test_cache_config.json")
+        self.assertEqual(config["project_id"], "first")
+
+    def test_sharedConfig(self):
+        config = iron_core.resolveConfig("iron_worker",
+                "test_cache_config.json")
+        first = iron_core.IronClient(name="Test", version="0.1.0",
+                product="iron_worker", config=config)
+        second = iron_core.IronClient(name="Test", version="0.1.0",
+                product="iron_worker", config=config, project_id="other")
+        self.assertEqual(first.project_id, "first")
+        self.assertEqual(second.project_id, "other")
+        self.assertEqual(config["project_id"], "first")
+
+
+def keystoneResponder(delay=0):
+    """Return a MockServer responder that issues numbered one hour Keystone
+    tokens, taking delay seconds to answer."""
+    issued = []
+
+    def responder(handler):
+        time.sleep(delay)
+        issued.append(None)
+        body = {"access": {"token": {"id": "token-%d" % len(issued),
+                "issued_at": "2014-01-01T10:00:00.000000Z",
+                "expires": "2014-01-01T11:00:00Z"}}}
+        return 200, {"Content-Type": "application/json"}, \
+                json.dumps(body).encode("utf-8")
+    return responder
+
+
+class TestKeystoneTokenProvider(unittest.TestCase):
+    def setUp(self):
+        self.server = MockServer(keystoneResponder(delay=.1))
+        self.provider = KeystoneTokenProvider({
+            "server": "http://127.0.0.1:%d" % self.server.server_address[1],
+            "tenant": "keystone-tenant",
+            "username": "keystone-username",
+            "password": "keystone-password"
+        })
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_singleFlight(self):
+        tokens = []
+        threads = [threading.Thread(
+                target=lambda: tokens.append(self.provider.getToken()))
+                for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(tokens, ["token-1"] * 10)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.provider.duration, 3600)
+        self.assertEqual(self.server.requests[0][1], "/tokens")
+
+    def test_backgroundRefresh(self):
+        self.assertEqual(self.provider.getToken(), "token-1")
+        self.provider.local_expires_at = iron_core.monotonic() + 30
+        self.assertEqual(self.provider.getToken(), "token-1")
+        self.assertEqual(self.provider.getToken(), "token-1")
+        deadline = time.time() + 5
+        while self.provider._refreshing and time.time() < deadline:
+            time.sleep(.01)
+        self.assertEqual(self.provider.getToken(), "token-2")
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_expiredRefreshesInForeground(self):
+        self.provider.getToken()
+        self.provider.local_expires_at = iron_core.monotonic() + 5
+        self.assertEqual(self.provider.getToken(), "token-2")
+
+    def test_timeout(self):
+        self.assertEqual(self.provider.timeout,
+                KeystoneTokenProvider.default_timeout)
+        self.provider.timeout = (1, .02)
+        self.assertRaises(requests.exceptions.Timeout,
+                self.provider.getToken)
+        client = iron_core.IronClient(name="Test", version="0.1.0",
+                product="iron_worker", project_id="TEST2",
+                keystone={"server": "http://localhost", "tenant": "t",
+                          "username": "u", "password": "p"},
+                connect_timeout=2, read_timeout=5)
+        self.assertEqual(client.token_provider.timeout, (2, 5))
+        self.assertEqual(client.token_provider.lock_timeout, 7)
+
+
+class TestKeystoneTokenCache(unittest.TestCase):
+    def setUp(self):
+        self.server = MockServer(keystoneResponder())
+        self.keystone = {
+            "server": "http://127.0.0.1:%d" % self.server.server_address[1],
+            "tenant": "keystone-tenant",
+            "username": "keystone-username",
+            "password": "keystone-password",
+            "cache_file": "test_token_cache.json"
+        }
+
+    def tearDown(self):
+        self.server.stop()
+        if os.path.exists("test_token_cache.json"):
+            os.remove("test_token_cache.json")
+
+    def test_sharedBetweenProviders(self):
+        first = KeystoneTokenProvider(self.keystone)
+        second = KeystoneTokenProvider(self.keystone)
+        self.assertEqual(first.getToken(), "token-1")
+        self.assertEqual(second.getToken(), "token-1")
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertTrue(second.local_expires_at - iron_core.monotonic() > 3590)
+        self.assertEqual(os.stat("test_token_cache.json").st_mode & 0o777,
+                0o600)
+
+    def test_keyedByUser(self):
+        KeystoneTokenProvider(self.keystone).getToken()
+        self.keystone["username"] = "someone-else"
+        self.assertEqual(KeystoneTokenProvider(self.keystone).getToken(),
+                "token-2")
+        with open("test_token_cache.json") as f:
+            self.assertEqual(len(json.loads(f.read())), 2)
+
+    def test_expiringEntryRefetched(self):
+        KeystoneTokenProvider(self.keystone).getToken()
+        with open("test_token_cache.json") as f:
+            cache = json.loads(f.read())
+        for entry in cache.values():
+            entry["expires_at"] = time.time() + 20
+        create_test_config("test_token_cache.json", cache)
+        self.assertEqual(KeystoneTokenProvider(self.keystone).getToken(),
+                "token-2")
+
+    def test_corruptCache(self):
+        with open("test_token_cache.json", "w") as f:
+            f.write("not json")
+        self.assertEqual(KeystoneTokenProvider(self.keystone).getToken(),
+                "token-1")
+
+    @unittest.skipIf(iron_core.fcntl is None, "requires fcntl")
+    def test_lockTimeout(self):
+        provider = KeystoneTokenProvider(self.keystone)
+        provider.lock_timeout = .2
+        with iron_core.lockedFile("test_token_cache.json"):
+            started = time.time()
+            self.assertEqual(provider.getToken(), "token-1")
+            self.assertTrue(time.time() - started < 2)
+        # The token fetched without the lock was not cached.
+        self.assertEqual(KeystoneTokenProvider(self.keystone).getToken(),
+                "token-2")
+
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        self.server = MockServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_connectionReuse(self):
+        client = self.server.client()
+        for i in range(5):
+            self.assertEqual(client.get("tasks")["body"], {"ok": True})
+        self.assertEqual(self.server.connections, 1)
+        client.close()
+
+    def test_closeReopensPool(self):
+        with self.server.client() as client:
+            client.get("tasks")
+            client.close()
+            client.get("tasks")
+        self.assertEqual(self.server.connections, 2)
+        self.assertTrue(client._session is None)
+
+    def test_idleTimeout(self):
+        client = self.server.client(pool_idle_timeout=0)
+        client.get("tasks")
+        client._session_used_at -= 1
+        client.get("tasks")
+        self.assertEqual(self.server.connections, 2)
+        client.close()
+
+    def test_poolConfig(self):
+        client = self.server.client(pool_connections=2, pool_maxsize=20)
+        adapter = client._getSession().get_adapter("http://127.0.0.1/")
+        self.assertEqual(adapter._pool_maxsize, 20)
+        self.assertEqual(adapter._pool_connections, 2)
+        self.assertFalse(adapter._pool_block)
+        client.close()
+
+    def test_poolBlock(self):
+        client = self.server.client(pool_block=True)
+        adapter = client._getSession().get_adapter("http://127.0.0.1/")
+        self.assertTrue(adapter._pool_block)
+        client.close()
+        client = self.server.client(pool_block="false")
+        self.assertFalse(client.pool_block)
+        client.close()
+
+
+class TestPreparedRequests(unittest.TestCase):
+    def setUp(self):
+        self.server = MockServer()
+        self.client = self.server.client()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_headersNotMutated(self):
+        headers = {"X-Custom": "1"}
+        self.client.get("tasks", headers=headers)
+        self.client.get("tasks")
+        self.assertEqual(headers, {"X-Custom": "1"})
+        self.assertFalse("Authorization" in self.client.headers)
+        self.assertEqual(self.client.get.__defaults__[0], {})
+        sent = [r[2] for r in self.server.requests]
+        self.assertEqual(sent[0]["X-Custom"], "1")
+        self.assertEqual(sent[0]["Authorization"], "OAuth TEST")
+        self.assertFalse("X-Custom" in sent[1])
+        self.assertEqual(sent[1]["Authorization"], "OAuth TEST")
+
+    def test_defaultHeadersReadOnly(self):
+        def mutate():
+            self.client.headers["X-Custom"] = "1"
+        self.assertRaises(TypeError, mutate)
+        self.client.headers = dict(self.client.headers, **{"X-Custom": "2"})
+        self.client.get("tasks")
+        self.assertEqual(self.server.requests[0][2]["X-Custom"], "2")
+
+    def test_authorizationFollowsToken(self):
+        first = self.client._authorize(self.client._default_headers, "a")
+        self.assertTrue(first is self.client._authorize(
+                self.client._default_headers, "a"))
+        second = self.client._authorize(self.client._default_headers, "b")
+        self.assertEqual(second["Authorization"], "OAuth b")
+        self.assertEqual(first["Authorization"], "OAuth a")
+
+    def test_urlCache(self):
+        url, headers = self.client._prepareRequest("tasks", {})
+        self.assertEqual(url, self.client.base_url + "tasks")
+        self.assertEqual(self.client._url_cache, {"tasks": url})
+        self.client.base_url = "http://elsewhere/2/"
+        self.assertEqual(self.client._prepareRequest("tasks", {})[0],
+                "http://elsewhere/2/tasks")
+        self.client.url_cache_size = 1
+        self.client._prepareRequest("other", {})
+        self.assertEqual(list(self.client._url_cache), ["other"])
+
+
+class TestHooks(unittest.TestCase):
+    def setUp(self):
+        statuses = [503, 200, 200, 404]
+        self.server = MockServer(lambda handler: (statuses.pop(0),
+                {"Content-Type": "application/json"}, b"{}"))
+        self.client = self.server.client(
+                retry_policy=iron_core.RetryPolicy(backoff=0))
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_events(self):
+        events = []
+
+        def hook(event, **info):
+            events.append((event, info["attempt"], info.get("status")))
+        for event in ("before_request", "after_response", "on_retry"):
+            self.client.addHook(event, hook)
+        self.client.get("tasks/1")
+        self.assertEqual(events, [("before_request", 1, None),
+                                  ("after_response", 1, 503),
+                                  ("on_retry", 1, 503),
+                                  ("before_request", 2, None),
+                                  ("after_response", 2, 200)])
+        for event in ("before_request", "after_response", "on_retry"):
+            self.client.removeHook(event, hook)
+        self.client.get("tasks/1")
+        self.assertEqual(len(events), 5)
+        self.assertEqual(self.client._hooks, {})
+        self.assertRaises(ValueError, self.client.addHook, "on_error", hook)
+
+    def test_metrics(self):
+        metrics = iron_core.MetricsCollector(buckets=[1, 60])
+        metrics.install(self.client)
+        self.client.get("tasks/123")
+        self.client.get("tasks/5f3a2b1c4d5e6f708192a3b4?log=1")
+        self.assertRaises(requests.exceptions.HTTPError, self.client.delete,
+                "tasks/9")
+        snapshot = metrics.snapshot()
+        counters = snapshot["counters"]
+        self.assertEqual(counters[("requests", "iron_worker", "GET",
+                                   "tasks/:id")], 3)
+        self.assertEqual(counters[("responses", "iron_worker", "GET",
+                                   "tasks/:id", 503)], 1)
+        self.assertEqual(counters[("retries", "iron_worker", "GET",
+                                   "tasks/:id")], 1)
+        self.assertEqual(counters[("responses", "iron_worker", "DELETE",
+                                   "tasks/:id", 404)], 1)
+        latency = snapshot["latency"][("iron_worker", "GET", "tasks/:id")]
+        self.assertEqual(latency["count"], 3)
+        self.assertEqual(latency["counts"], [3, 0, 0])
+        metrics.uninstall(self.client)
+        self.assertEqual(self.client._hooks, {})
+
+    def test_tokenRefresh(self):
+        keystone = MockServer(keystoneResponder())
+        try:
+            client = iron_core.IronClient(name="Test", version="0.1.0",
+                    product="iron_worker", project_id="TEST2",
+                    protocol="http", host="127.0.0.1",
+                    port=self.server.server_address[1], keystone={
+                        "server": "http://127.0.0.1:%d" %
+                                  keystone.server_address[1],
+                        "tenant": "t", "username": "u", "password": "p"})
+            metrics = iron_core.MetricsCollector()
+            metrics.install(client)
+            client.token_provider.getToken()
+            counters = metrics.snapshot()["counters"]
+            self.assertEqual(counters[("token_refreshes", "iron_worker")], 1)
+        finally:
+            keystone.stop()
+
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        import gzip
+        payload = gzip.compress(b'{"value": "' + b"x" * 5000 + b'"}')
+        self.server = MockServer(lambda handler: (200,
+                {"Content-Type": "application/json",
+                 "Content-Encoding": "gzip"}, payload))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_compressesLargeBodies(self):
+        client = self.server.client(compression="gzip",
+                compression_threshold=100)
+        body = json.dumps({"messages": [{"body": "y" * 5000}]})
+        client.post("queues/q/messages", body=body)
+        client.post("queues/q/messages", body="small")
+        method, path, headers, sent = self.server.requests[0]
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(int(headers["Content-Length"]), len(sent))
+        self.assertTrue(len(sent) < 200)
+        self.assertEqual(zlib.decompress(sent, 31).decode("utf-8"), body)
+        self.assertFalse("Content-Encoding" in self.server.requests[1][2])
+        client.close()
+
+    def test_deflateAndGetUntouched(self):
+        client = self.server.client(compression="deflate",
+                compression_threshold=0, compression_level=1)
+        client.put("caches/c/items/k", body={"value": "z" * 100})
+        client.get("caches/c/items/k")
+        sent = self.server.requests[0][3]
+        self.assertEqual(json.loads(zlib.decompress(sent).decode("utf-8")),
+                {"value": "z" * 100})
+        self.assertFalse("Content-Encoding" in self.server.requests[1][2])
+        client.close()
+
+    def test_deleteUntouched(self):
+        client = self.server.client(compression="gzip",
+                compression_threshold=0)
+        client.delete("queues/q/messages", body={"ids": ["1"] * 100})
+        method, path, headers, sent = self.server.requests[0]
+        self.assertFalse("Content-Encoding" in headers)
+        self.assertEqual(json.loads(sent.decode("utf-8")),
+                {"ids": ["1"] * 100})
+        client.close()
+
+    def test_decodesResponses(self):
+        client = self.server.client()
+        result = client.get("caches/c/items/k")
+        self.assertEqual(result["body"], {"value": "x" * 5000})
+        self.assertEqual(self.server.requests[0][2]["Accept-Encoding"],
+                "gzip, deflate")
+        client.get("caches/c/items/k",
+                headers={"Accept-Encoding": "identity"})
+        self.assertEqual(self.server.requests[1][2]["Accept-Encoding"],
+                "identity")
+        self.assertRaises(ValueError, self.server.client, compression="br")
+        client.close()
+
+
+class TestRequestMany(unittest.TestCase):
+    def setUp(self):
+        def responder(handler):
+            if handler.path.endswith("/missing"):
+                return 404, {"Content-Type": "text/plain"}, b"not found"
+            return 200, {"Content-Type": "application/json"}, \
+                    json.dumps({"path": handler.path}).encode("utf-8")
+        self.server = MockServer(responder)
+        self.client = self.server.client()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_orderingAndErrors(self):
+        specs = [("GET", "tasks/%d" % i) for i in range(10)]
+        specs.insert(3, ("GET", "missing"))
+        specs.append({"method": "POST", "url": "tasks", "body": "{}",
+                      "headers": {"Content-Type": "application/json"}})
+        results = self.client.request_many(specs, max_concurrency=4)
+
+        self.assertEqual(len(results), 12)
+        self.assertTrue(isinstance(results[3], Exception))
+        self.assertEqual(results[3].response.status_code, 404)
+        paths = [r["body"]["path"] for i, r in enumerate(results) if i != 3]
+        expected = ["/2/projects/TEST2/tasks/%d" % i for i in range(10)]
+        self.assertEqual(paths, expected + ["/2/projects/TEST2/tasks"])
+        self.assertTrue(self.server.connections <= 4)
+
+    def test_empty(self):
+        self.assertEqual(self.client.request_many([]), [])
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_legacySchedule(self):
+        policy = iron_core.RetryPolicy()
+        delays = [policy.nextDelay("GET", attempt, 0, status=503)
+                  for attempt in range(1, 7)]
+        self.assertEqual(delays, [.5, 1, 2, 4, 8, None])
+        self.assertEqual(policy.retries, 5)
+        self.assertEqual(policy.retried_statuses, {503: 5})
+        self.assertEqual(policy.nextDelay("GET", 1, 0, status=500), None)
+
+    def test_jitterAndCaps(self):
+        policy = iron_core.RetryPolicy(jitter="full", max_backoff=1)
+        for attempt in range(1, 6):
+            delay = policy.nextDelay("GET", attempt, 0, status=503)
+            self.assertTrue(0 <= delay <= 1)
+        policy = iron_core.RetryPolicy(jitter="decorrelated", max_backoff=3)
+        previous = None
+        for attempt in range(1, 6):
+            previous = policy.nextDelay("GET", attempt, 0, previous, 503)
+            self.assertTrue(.5 <= previous <= 3)
+        self.assertRaises(ValueError, iron_core.RetryPolicy, jitter="some")
+
+    def test_retryAfterAndDeadline(self):
+        policy = iron_core.RetryPolicy(deadline=10)
+        self.assertEqual(policy.nextDelay("GET", 1, 0, status=503,
+                retry_after="7"), 7)
+        self.assertEqual(policy.nextDelay("GET", 1, 5, status=503,
+                retry_after="7"), None)
+        self.assertEqual(policy.nextDelay("GET", 1, 0, status=503,
+                retry_after="3600"), None)
+        policy = iron_core.RetryPolicy()
+        self.assertEqual(policy.nextDelay("GET", 1, 0, status=503,
+                retry_after="8"), 8)
+        self.assertEqual(policy.nextDelay("GET", 1, 0, status=503,
+                retry_after="100"), None)
+        policy = iron_core.RetryPolicy(max_backoff=5)
+        self.assertEqual(policy.nextDelay("GET", 1, 0, status=503,
+                retry_after="5"), 5)
+        self.assertEqual(policy.nextDelay("GET", 1, 0, status=503,
+                retry_after="3600"), None)
+        policy = iron_core.RetryPolicy(max_backoff=5, max_retry_after=60)
+        self.assertEqual(policy.nextDelay("GET", 1, 0, status=503,
+                retry_after="30"), 30)
+        self.assertEqual(iron_core.parseRetryAfter("soon"), None)
+        self.assertEqual(iron_core.parseRetryAfter(
+                "Wed, 21 Oct 2015 07:28:00 GMT"), 0)
+
+    def test_errors(self):
+        policy = iron_core.RetryPolicy()
+        self.assertEqual(policy.nextDelay("GET", 1, 0,
+                error="connection"), None)
+        policy = iron_core.RetryPolicy(retry_connection_errors=True,
+                retry_timeouts=True)
+        self.assertEqual(policy.nextDelay("GET", 1, 0,
+                error="connection"), .5)
+        self.assertEqual(policy.nextDelay("PUT", 1, 0, error="timeout"), .5)
+        self.assertEqual(policy.nextDelay("POST", 1, 0,
+                error="connection"), None)
+        self.assertEqual(policy.retried_errors,
+                {"connection": 1, "timeout": 1})
+
+    def test_clientRetries(self):
+        statuses = [503, 503, 200]
+
+        def responder(handler):
+            return statuses.pop(0), {"Content-Type": "application/json",
+                                     "Retry-After": "0"}, b"{}"
+        server = MockServer(responder)
+        try:
+            policy = iron_core.RetryPolicy()
+            client = server.client(retry_policy=policy)
+            self.assertEqual(client.get("tasks")["status"], 200)
+            self.assertEqual(policy.retries, 2)
+            statuses[:] = [503, 200]
+            self.assertRaises(Exception, client.get, "tasks", retry=False)
+            self.assertEqual(client.get("tasks",
+                    retry=iron_core.RetryPolicy(backoff=0))["status"], 200)
+            client.close()
+        finally:
+            server.stop()
+
+    def test_clientConnectionErrors(self):
+        server = MockServer()
+        port = server.server_address[1]
+        server.stop()
+        client = iron_core.IronClient(name="Test", version="0.1.0",
+                product="iron_worker", token="TEST", project_id="TEST2",
+                protocol="http", host="127.0.0.1", port=port)
+        policy = iron_core.RetryPolicy(backoff=0, max_attempts=3,
+                retry_connection_errors=True)
+        self.assertRaises(requests.exceptions.ConnectionError,
+                client.get, "tasks", retry=policy)
+        self.assertEqual(policy.retried_errors, {"connection": 2})
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_states(self):
+        breaker = iron_core.CircuitBreaker(minimum_requests=4, cooldown=60)
+        for success in (True, False, True):
+            breaker.record("a", success)
+        self.assertEqual(breaker.state("a"), breaker.CLOSED)
+        breaker.record("a", False)
+        self.assertEqual(breaker.state("a"), breaker.OPEN)
+        self.assertFalse(breaker.allow("a"))
+        self.assertTrue(breaker.allow("b"))
+
+        breaker._hosts["a"]["opened_at"] -= 60
+        self.assertEqual(breaker.state("a"), breaker.HALF_OPEN)
+        self.assertTrue(breaker.allow("a"))
+        self.assertFalse(breaker.allow("a"))
+        breaker.record("a", False)
+        self.assertEqual(breaker.state("a"), breaker.OPEN)
+
+        breaker._hosts["a"]["opened_at"] -= 60
+        self.assertTrue(breaker.allow("a"))
+        breaker.record("a", True)
+        self.assertEqual(breaker.state("a"), breaker.CLOSED)
+        self.assertTrue(breaker.allow("a"))
+
+    def test_clientFailsFast(self):
+        server = MockServer(lambda handler: (503, {}, b""))
+        try:
+            breaker = iron_core.CircuitBreaker(minimum_requests=3)
+            client = server.client(circuit_breaker=breaker,
+                    retry_policy=iron_core.RetryPolicy(backoff=0))
+            self.assertRaises(requests.exceptions.HTTPError,
+                    client.get, "tasks")
+            self.assertEqual(len(server.requests), 3)
+            self.assertRaises(iron_core.CircuitOpenError, client.get, "tasks")
+            self.assertEqual(len(server.requests), 3)
+            client.close()
+        finally:
+            server.stop()
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_bucket(self):
+        bucket = iron_core.TokenBucket(10, burst=2)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(timeout=.05), None)
+        self.assertAlmostEqual(bucket.reserve(), .1, places=2)
+        self.assertAlmostEqual(bucket.reserve(), .2, places=2)
+
+    def test_sharedBucket(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "bucket.json")
+            first = iron_core.SharedTokenBucket(path, 1, burst=2)
+            second = iron_core.SharedTokenBucket(path, 1, burst=2)
+            self.assertEqual(first.reserve(), 0)
+            self.assertEqual(second.reserve(), 0)
+            self.assertFalse(first.acquire(timeout=.5))
+            self.assertFalse(second.acquire(timeout=.5))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_rules(self):
+        limiter = iron_core.RateLimiter({
+                "iron_mq/*": 100,
+                "*/project/*": (10, 5),
+                "iron_mq/*/queues/*/messages": 1})
+        self.assertEqual(len(limiter.buckets("iron_mq", "other",
+                "queues/q/messages?n=1")), 2)
+        self.assertEqual(len(limiter.buckets("iron_mq", "project",
+                "queues/q")), 2)
+        self.assertEqual(len(limiter.buckets("iron_worker", "other",
+                "tasks")), 0)
+        self.assertEqual(limiter.reserve("iron_mq", "p", "queues/q/messages"),
+                0)
+        self.assertEqual(limiter.reserve("iron_mq", "p", "queues/q/messages",
+                timeout=.5), None)
+        # A refused reservation hands back what it took from other rules.
+        self.assertTrue(98.5 < limiter.rules[0][1]._level < 99.5)
+
+    def test_client(self):
+        server = MockServer()
+        try:
+            limiter = iron_core.RateLimiter([("iron_worker/*", 20, 1)])
+            client = server.client(rate_limiter=limiter)
+            throttles = []
+            client.addHook("on_throttle",
+                    lambda **info: throttles.append(info["delay"]))
+            started = time.time()
+            for i in range(3):
+                client.get("tasks")
+            self.assertTrue(time.time() - started >= .09)
+            self.assertEqual(len(throttles), 2)
+            limiter = iron_core.RateLimiter([("iron_worker/*", .1, 1)])
+            client = server.client(rate_limiter=limiter)
+            client.get("tasks")
+            self.assertRaises(iron_core.IronTimeoutError, client.get, "tasks",
+                    deadline=1)
+            self.assertEqual(len(server.requests), 4)
+            client.close()
+        finally:
+            server.stop()
+
+
+class TestCoalescing(unittest.TestCase):
+    def setUp(self):
+        def responder(handler):
+            time.sleep(.2)
+            if "missing" in handler.path:
+                return 404, {}, b""
+            return 200, {"Content-Type": "application/json"}, b'{"ok": true}'
+        self.server = MockServer(responder)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def getAll(self, client, *calls):
+        results = [None] * len(calls)
+
+        def run(i, call):
+            try:
+                results[i] = call()
+            except Exception as e:
+                results[i] = e
+        threads = [threading.Thread(target=run, args=(i, call))
+                   for i, call in enumerate(calls)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_identicalGets(self):
+        client = self.server.client(coalescer=True)
+        results = self.getAll(client, *[lambda: client.get("tasks/1")] * 5)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(client.coalescer.shared, 4)
+        self.assertEqual([r["body"] for r in results], [{"ok": True}] * 5)
+        self.assertEqual(len(set(id(r) for r in results)), 5)
+        results[0]["body"]["ok"] = False
+        self.assertEqual(results[1]["body"], {"ok": True})
+        client.close()
+
+    def test_distinctRequests(self):
+        client = self.server.client(coalescer=True)
+        self.getAll(client, lambda: client.get("tasks/1"),
+                lambda: client.get("tasks/2"),
+                lambda: client.get("tasks/1", headers={"X-Extra": "1"}),
+                lambda: client.post("tasks/1"),
+                lambda: client.get("tasks/1", stream=True))
+        self.assertEqual(len(self.server.requests), 5)
+        other = self.server.client(coalescer=client.coalescer, token="OTHER")
+        self.getAll(client, lambda: client.get("tasks/1"),
+                lambda: other.get("tasks/1"))
+        self.assertEqual(len(self.server.requests), 7)
+        client.close()
+        other.close()
+
+    def test_sharedError(self):
+        client = self.server.client(coalescer=True)
+        results = self.getAll(client, *[lambda: client.get("missing")] * 3)
+        self.assertEqual(len(self.server.requests), 1)
+        for result in results:
+            self.assertTrue(isinstance(result, requests.exceptions.HTTPError))
+        self.assertEqual(client.coalescer._calls, {})
+        client.close()
+
+
+def unusedPort():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestFailover(unittest.TestCase):
+    def setUp(self):
+        self.fast = MockServer()
+
+        def slow(handler):
+            time.sleep(.05)
+            return 200, {"Content-Type": "application/json"}, b'{"ok": true}'
+        self.slow = MockServer(slow)
+        self.dead = "127.0.0.1:%d" % unusedPort()
+
+    def tearDown(self):
+        self.fast.stop()
+        self.slow.stop()
+
+    def endpoint(self, server):
+        return "127.0.0.1:%d" % server.server_address[1]
+
+    def test_noHost(self):
+        client = iron_core.IronClient(name="Test", version="0.1.0",
+                product="custom", token="TEST", project_id="TEST2",
+                api_version=1)
+        self.assertEqual(client.hosts, [None])
+
+    def client(self, *servers, **kwargs):
+        hosts = [server if isinstance(server, str) else self.endpoint(server)
+                 for server in servers]
+        client = iron_core.IronClient(name="Test", version="0.1.0",
+                product="iron_worker", token="TEST", project_id="TEST2",
+                protocol="http", host=hosts, **kwargs)
+        self.urls = []
+        client.addHook("before_request",
+                lambda **info: self.urls.append(info["url"]))
+        return client
+
+    def test_config(self):
+        client = iron_core.IronClient(name="Test", version="0.1.0",
+                product="iron_worker", token="TEST", project_id="TEST2",
+                host="a.example.com, b.example.com:8080")
+        self.assertEqual(client.hosts, ["a.example.com", "b.example.com:8080"])
+        self.assertEqual(client.base_url,
+                "https://a.example.com/2/projects/TEST2/")
+        self.assertEqual(client._base_urls["b.example.com:8080"],
+                "https://b.example.com:8080/2/projects/TEST2/")
+        self.assertTrue(isinstance(client.host_selector,
+                iron_core.HostSelector))
+        self.assertEqual(self.fast.client().host_selector, None)
+
+    def test_failover(self):
+        client = self.client(self.dead, self.fast)
+        self.assertEqual(client.get("tasks/1")["body"], {"ok": True})
+        self.assertEqual(len(self.urls), 2)
+        self.assertTrue(self.dead in self.urls[0])
+        self.assertEqual(client.host_selector.stats(self.dead)["errors"], 1)
+        client.get("tasks/2")
+        self.assertEqual(len(self.urls), 3)
+        self.assertEqual(len(self.fast.requests), 2)
+        client.close()
+
+    def test_noFailoverForPost(self):
+        client = self.client(self.dead, self.fast)
+        self.assertRaises(requests.exceptions.ConnectionError, client.post,
+                "tasks", body="{}")
+        self.assertEqual(len(self.urls), 1)
+        client.post("tasks", body="{}")
+        self.assertEqual(len(self.fast.requests), 1)
+        client.close()
+
+    def test_preferFastest(self):
+        client = self.client(self.slow, self.fast)
+        for i in range(6):
+            client.get("tasks/%d" % i)
+        self.assertEqual(len(self.slow.requests), 1)
+        self.assertEqual(len(self.fast.requests), 5)
+        self.assertEqual(client.host_selector.rank(client.hosts),
+                [self.endpoint(self.fast), self.endpoint(self.slow)])
+        client.close()
+
+    def test_circuitOpen(self):
+        breaker = iron_core.CircuitBreaker(minimum_requests=1)
+        client = self.client(self.dead, self.fast, circuit_breaker=breaker)
+        client.get("tasks/1")
+        self.assertEqual(breaker.state(self.dead), breaker.OPEN)
+        client.host_selector = iron_core.HostSelector()
+        client.get("tasks/2")
+        self.assertEqual(len(self.fast.requests), 2)
+        client.close()
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        def responder(handler):
+            headers = {"Content-Type": "application/json"}
+            if "etag" in handler.path:
+                if handler.headers.get("If-None-Match") == '"v1"':
+                    return 304, {"ETag": '"v1"'}, b""
+                headers["ETag"] = '"v1"'
+            if "nostore" in handler.path:
+                headers["Cache-Control"] = "no-store"
+            return 200, headers, b'{"ok": true}'
+        self.server = MockServer(responder)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_fresh(self):
+        client = self.server.client(response_cache=True)
+        first = client.get("queues/q")
+        second = client.get("queues/q")
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(second["body"], {"ok": True})
+        self.assertFalse(first is second)
+        self.assertEqual((client.response_cache.hits,
+                client.response_cache.misses), (1, 1))
+        client.get("queues/q", headers={"X-Other": "1"})
+        client.get("queues/q?n=2")
+        self.assertEqual(len(self.server.requests), 3)
+        client.close()
+
+    def test_revalidate(self):
+        cache = iron_core.ResponseCache(ttl=0)
+        client = self.server.client(response_cache=cache)
+        client.get("codes/etag")
+        result = client.get("codes/etag")
+        self.assertEqual(result["status"], 200)
+        self.assertEqual(result["body"], {"ok": True})
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[1][2]["If-None-Match"], '"v1"')
+        self.assertEqual(cache.revalidations, 1)
+        client.get("codes/plain")
+        client.get("codes/plain")
+        self.assertFalse("If-None-Match" in self.server.requests[3][2])
+        client.close()
+
+    def test_invalidate(self):
+        client = self.server.client(response_cache=True)
+        for path in ("queues", "queues/q", "queues/q/messages", "queues/r"):
+            client.get(path)
+        client.post("queues/q/messages", body="{}")
+        self.assertEqual(len(client.response_cache), 1)
+        client.get("queues/r")
+        client.get("queues/q")
+        self.assertEqual(len(self.server.requests), 6)
+        client.close()
+
+    def test_limits(self):
+        cache = iron_core.ResponseCache(max_entries=2,
+                ttls={"schedules*": None})
+        client = self.server.client(response_cache=cache)
+        for path in ("a", "b", "a", "c", "schedules", "nostore"):
+            client.get(path)
+        self.assertEqual(len(cache), 2)
+        client.get("a")
+        client.get("c")
+        client.get("b")
+        self.assertEqual(len(self.server.requests), 6)
+        client.close()
+
+
+class TestAutoBatcher(unittest.TestCase):
+    def setUp(self):
+        self.counter = 0
+        self.lock = threading.Lock()
+
+        def responder(handler):
+            if "missing" in handler.path:
+                return 404, {}, b""
+            messages = json.loads(handler.body.decode("utf-8"))["messages"]
+            with self.lock:
+                ids = [str(self.counter + i) for i in range(len(messages))]
+                self.counter += len(messages)
+            if "short" in handler.path:
+                ids = ids[1:]
+            return 200, {"Content-Type": "application/json"}, \
+                json.dumps({"ids": ids}).encode("utf-8")
+        self.server = MockServer(responder)
+        self.client = self.server.client()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_batches(self):
+        batcher = iron_core.AutoBatcher(self.client, max_items=100,
+                max_delay=.05)
+        futures = []
+
+        def submit():
+            for i in range(50):
+                futures.append(batcher.submit("queues/q/messages",
+                        {"body": "m%d" % i}))
+        threads = [threading.Thread(target=submit) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        results = [future.result(5) for future in futures]
+        batcher.close()
+        self.assertEqual(sorted(results, key=int),
+                [str(i) for i in range(250)])
+        self.assertEqual(batcher.items, 250)
+        self.assertTrue(len(self.server.requests) <= 5)
+        method, path, headers, body = self.server.requests[0]
+        self.assertEqual((method, path),
+                ("POST", "/2/projects/TEST2/queues/q/messages"))
+        self.assertTrue(len(json.loads(body.decode("utf-8"))["messages"])
+                <= 100)
+
+    def test_delay(self):
+        with iron_core.AutoBatcher(self.client, max_delay=.1) as batcher:
+            started = time.time()
+            futures = [batcher.submit("queues/q/messages", {"body": "m"}),
+                       batcher.submit("queues/r/messages", {"body": "m"}),
+                       batcher.submit("queues/q/messages", {"body": "m"})]
+            [future.result(5) for future in futures]
+            self.assertTrue(time.time() - started >= .09)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertRaises(RuntimeError, batcher.submit, "queues/q/messages",
+                {"body": "m"})
+
+    def test_errors(self):
+        batcher = iron_core.AutoBatcher(self.client, max_delay=10)
+        missing = batcher.submit("queues/missing/messages", {"body": "m"})
+        short = [batcher.submit("queues/short/messages", {"body": "m"}),
+                 batcher.submit("queues/short/messages", {"body": "m"})]
+        batcher.flush()
+        self.assertTrue(isinstance(missing.exception(),
+                requests.exceptions.HTTPError))
+        for future in short:
+            self.assertTrue(isinstance(future.exception(), ValueError))
+        batcher.close()
+
+
+class TestThreadSafety(unittest.TestCase):
+    def setUp(self):
+        self.server = MockServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_sharedClient(self):
+        client = self.server.client(pool_maxsize=8)
+        defaults = dict(client.headers)
+        headers = {"X-Caller": "1"}
+        errors = []
+
+        def run():
+            try:
+                for i in range(20):
+                    client.get("tasks/%d" % i, headers=headers)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=run) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(headers, {"X-Caller": "1"})
+        self.assertEqual(dict(client.headers), defaults)
+        self.assertEqual(len(self.server.requests), 160)
+        for method, path, sent, body in self.server.requests:
+            self.assertEqual(sent["Authorization"], "OAuth TEST")
+            self.assertEqual(sent["X-Caller"], "1")
+        self.assertTrue(self.server.connections <= 8)
+        client.close()
+
+    @unittest.skipUnless(hasattr(os, "fork"), "requires os.fork")
+    def test_fork(self):
+        coalescer = iron_core.RequestCoalescer()
+        client = self.server.client(coalescer=coalescer)
+        client.get("tasks")
+        session = client._session
+        # Locks and calls another thread of the parent holds when it forks
+        # must not leave the child stuck.
+        client._session_lock.acquire()
+        key = client._coalesceKey(client.base_url + "tasks",
+                client._default_headers)
+        coalescer._calls[key] = {"done": threading.Event(), "result": None,
+                                 "error": None}
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                result = client.get("tasks")
+                if result["status"] == 200 and client._session is not session:
+                    status = 0
+            finally:
+                os._exit(status)
+        client._session_lock.release()
+        del coalescer._calls[key]
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertTrue(client._session is session)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.connections, 2)
+        client.close()
+
+
+class H2Server(object):
+    """A minimal HTTP/2 server without TLS, answering every request with a
+    small JSON body, that counts connections and streams."""
+
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.connections = 0
+        self.streams = 0
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn = self.sock.accept()[0]
+            except (socket.error, OSError):
+                return
+            self.connections += 1
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        h2conn = h2.connection.H2Connection(
+                config=h2.config.H2Configuration(client_side=False))
+        h2conn.initiate_connection()
+        conn.sendall(h2conn.data_to_send())
+        paths = {}
+        while True:
+            data = conn.recv(65535)
+            if not data:
+                break
+            for event in h2conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    paths[event.stream_id] = dict(event.headers)
+                elif isinstance(event, h2.events.DataReceived):
+                    h2conn.acknowledge_received_data(
+                            event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.StreamEnded):
+                    self.streams += 1
+                    path = paths.pop(event.stream_id)[b":path"]
+                    status = b"404" if b"missing" in path else b"200"
+                    body = b'{"ok": true}'
+                    h2conn.send_headers(event.stream_id, [
+                            (":status", status),
+                            ("content-type", "application/json"),
+                            ("content-length", str(len(body)))])
+                    h2conn.send_data(event.stream_id, body, end_stream=True)
+            conn.sendall(h2conn.data_to_send())
+        conn.close()
+
+    def stop(self):
+        self.sock.close()
+
+
+@unittest.skipIf(httpx is None, "requires httpx and h2")
+class TestHttp2Transport(unittest.TestCase):
+    def test_config(self):
+        self.assertRaises(ValueError, iron_core.IronClient, name="Test",
+                version="0.1.0", product="iron_worker", token="TEST",
+                project_id="TEST2", transport="carrier-pigeon")
+        client = iron_core.IronClient(name="Test", version="0.1.0",
+                product="iron_worker", token="TEST", project_id="TEST2",
+                transport="http2")
+        self.assertTrue(client.transport is iron_core.Http2Transport)
+
+    def test_missingHttpx(self):
+        httpx = sys.modules.get("httpx")
+        sys.modules["httpx"] = None
+        try:
+            self.assertRaises(ImportError, iron_core.IronClient, name="Test",
+                    version="0.1.0", product="iron_worker", token="TEST",
+                    project_id="TEST2", transport="http2")
+        finally:
+            if httpx is None:
+                del sys.modules["httpx"]
+            else:
+                sys.modules["httpx"] = httpx
+
+    def test_multiplexing(self):
+        server = H2Server()
+        try:
+            client = iron_core.IronClient(name="Test", version="0.1.0",
+                    product="iron_worker", token="TEST", project_id="TEST2",
+                    protocol="http", host="127.0.0.1", port=server.port,
+                    transport=lambda client: iron_core.Http2Transport(client,
+                                                                  http1=False))
+            result = client.get("tasks/0")
+            self.assertEqual(result["body"], {"ok": True})
+            self.assertEqual(result["resp"].http_version, "HTTP/2")
+            errors = []
+
+            def run(i):
+                try:
+                    client.get("tasks/%d" % i)
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=run, args=(i,))
+                       for i in range(20)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(server.streams, 21)
+            self.assertEqual(server.connections, 1)
+            self.assertRaises(requests.exceptions.HTTPError, client.get,
+                    "missing")
+            client.close()
+        finally:
+            server.stop()
+
+    def test_http1Fallback(self):
+        server = MockServer(lambda handler: (404 if "missing" in handler.path
+                else 200, {"Content-Type": "application/json"},
+                b'[{"a": 1},\n{"a": 2}]'))
+        try:
+            client = server.client(transport="http2")
+            self.assertEqual(client.get("tasks")["body"], [{"a": 1}, {"a": 2}])
+            self.assertEqual(list(client.get("tasks", stream="json")["body"]),
+                    [{"a": 1}, {"a": 2}])
+            self.assertEqual(list(client.get("tasks", stream="lines")["body"]),
+                    [b'[{"a": 1},', b'{"a": 2}]'])
+            client.post("tasks", body=io.BytesIO(b"data"))
+            self.assertEqual(server.requests[-1][3], b"data")
+            client.post("tasks", body=bytearray(b"array"))
+            self.assertEqual(server.requests[-1][3], b"array")
+            client.post("tasks", body=memoryview(b"view"))
+            self.assertEqual(server.requests[-1][3], b"view")
+            self.assertRaises(requests.exceptions.HTTPError, client.get,
+                    "missing")
+            client.close()
+        finally:
+            server.stop()
+
+    def test_connectionError(self):
+        client = iron_core.IronClient(name="Test", version="0.1.0",
+                product="iron_worker", token="TEST", project_id="TEST2",
+                protocol="http", host="127.0.0.1", port=unusedPort(),
+                transport="http2")
+        self.assertRaises(requests.exceptions.ConnectionError, client.get,
+                "tasks")
+        transport = client._getSession()
+        self.assertRaises(requests.exceptions.InvalidSchema,
+                transport.request, "GET", "ftp://127.0.0.1/tasks")
+
+
+class TestTimeouts(unittest.TestCase):
+    def setUp(self):
+        def responder(handler):
+            time.sleep(float(handler.path.rsplit("/", 1)[1]))
+            return 503 if "unavailable" in handler.path else 200, {}, b""
+        self.server = MockServer(responder)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_config(self):
+        os.environ["IRON_WORKER_READ_TIMEOUT"] = "2.5"
+        iron_core.invalidateConfigCache()
+        try:
+            client = self.server.client(connect_timeout=1)
+        finally:
+            del os.environ["IRON_WORKER_READ_TIMEOUT"]
+            iron_core.invalidateConfigCache()
+        self.assertEqual((client.connect_timeout, client.read_timeout),
+                (1.0, 2.5))
+        self.assertEqual(client._attemptTimeout(iron_core.monotonic(), None),
+                (1.0, 2.5))
+        self.assertEqual(self.server.client()._attemptTimeout(
+                iron_core.monotonic(), None), None)
+
+    def test_readTimeout(self):
+        client = self.server.client(read_timeout=.1)
+        self.assertRaises(iron_core.IronTimeoutError, client.get, "slow/.5")
+        self.assertEqual(client.get("slow/0")["status"], 200)
+        client.close()
+
+    def test_deadlineAcrossRetries(self):
+        client = self.server.client()
+        started = time.time()
+        self.assertRaises(iron_core.IronTimeoutError, client.get,
+                "unavailable/0", deadline=1)
+        # The .5s first retry fits in the deadline, the 1s second does not.
+        self.assertTrue(time.time() - started < 1)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_deadlineCapsAttempt(self):
+        client = self.server.client(read_timeout=10)
+        self.assertRaises(iron_core.IronTimeoutError, client.get,
+                "slow/1", deadline=.2)
+        client.close()
+
+    def test_bodyStall(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(8)
+        stop = threading.Event()
+
+        def stall(conn):
+            conn.recv(65536)
+            conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n"
+                         b"Content-Type: application/json\r\n\r\n{")
+            stop.wait(2)
+            conn.close()
+
+        def serve():
+            while not stop.is_set():
+                try:
+                    conn = listener.accept()[0]
+                except (socket.error, OSError):
+                    return
+                thread = threading.Thread(target=stall, args=(conn,))
+                thread.daemon = True
+                thread.start()
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+        policy = iron_core.RetryPolicy(retry_timeouts=True, backoff=0,
+                max_attempts=2)
+        client = iron_core.IronClient(name="Test", version="0.1.0",
+                product="iron_worker", token="TEST", project_id="TEST2",
+                protocol="http", host="127.0.0.1",
+                port=listener.getsockname()[1], read_timeout=.3,
+                retry_policy=policy)
+        try:
+            started = time.time()
+            self.assertRaises(iron_core.IronTimeoutError, client.get,
+                    "tasks")
+            self.assertTrue(time.time() - started < 1.5)
+            self.assertEqual(policy.retried_errors, {"timeout": 1})
+            body = client.get("tasks", stream=True, retry=False)["body"]
+            self.assertRaises(iron_core.IronTimeoutError, list, body)
+        finally:
+            stop.set()
+            listener.close()
+            client.close()
+
+    def test_deadlineIgnoresClockSteps(self):
+        client = self.server.client()
+        wall_clock = time.time
+        steps = []
+
+        def stepping():
+            steps.append(None)
+            return wall_clock() + 3600 * len(steps)
+        time.time = stepping
+        try:
+            self.assertEqual(client.get("slow/0", deadline=5)["status"], 200)
+        finally:
+            time.time = wall_clock
+        client.close()
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        def responder(handler):
+            if handler.path.endswith("/log"):
+                return 200, {"Content-Type": "text/plain"}, \
+                        b"line one\nline two\nline three\n"
+            if handler.path.endswith("/missing"):
+                return 404, {}, b""
+            return 200, {"Content-Type": "application/json"}, \
+                    json.dumps([{"id": i} for i in range(1000)]).encode()
+        self.server = MockServer(responder)
+        self.client = self.server.client()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_chunks(self):
+        self.client.stream_chunk_size = 7
+        result = self.client.get("tasks/1/log", stream=True)
+        self.assertEqual(result["content-type"], "text/plain")
+        chunks = list(result["body"])
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(b"".join(chunks),
+                b"line one\nline two\nline three\n")
+
+    def test_lines(self):
+        result = self.client.get("tasks/1/log", stream="lines")
+        self.assertEqual(list(result["body"]),
+                [b"line one", b"line two", b"line three"])
+
+    def test_json(self):
+        self.client.stream_chunk_size = 100
+        result = self.client.get("tasks", stream="json")
+        self.assertEqual(list(result["body"]),
+                [{"id": i} for i in range(1000)])
+        # The connection went back to the pool once the body was consumed.
+        self.client.get("tasks")
+        self.assertEqual(self.server.connections, 1)
+
+    def test_errors(self):
+        self.assertRaises(requests.exceptions.HTTPError, self.client.get,
+                "missing", stream=True)
+        self.assertRaises(ValueError, self.client.get, "tasks",
+                stream="xml")
+        self.assertRaises(ValueError, list,
+                iron_core.iterJsonArray([b'{"a": 1}']))
+        self.assertRaises(ValueError, list, iron_core.iterJsonArray([b"[1"]))
+
+    def test_iterJsonArraySplits(self):
+        data = json.dumps([1.5, "a,]", {"b": [1, 2]}, None, 12345]).encode()
+        for size in (1, 2, 5):
+            chunks = [data[i:i + size] for i in range(0, len(data), size)]
+            self.assertEqual(list(iron_core.iterJsonArray(chunks)),
+                    json.loads(data.decode()))
+
+
+class TestUploads(unittest.TestCase):
+    def setUp(self):
+        self.server = MockServer()
+        self.client = self.server.client()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        if os.path.exists("test_upload.bin"):
+            os.remove("test_upload.bin")
+
+    def received(self):
+        method, path, headers, body = self.server.requests[-1]
+        return headers, body
+
+    def test_text(self):
+        self.client.post("messages", body=u"caf\u00e9")
+        headers, body = self.received()
+        self.assertEqual(headers["Content-Length"], "5")
+        self.assertEqual(body, u"caf\u00e9".encode("utf-8"))
+
+    def test_fileObject(self):
+        with open("test_upload.bin", "wb") as f:
+            f.write(b"x" * 100000)
+        with open("test_upload.bin", "rb") as f:
+            f.read(10)
+            self.client.put("code", body=f)
+        headers, body = self.received()
+        self.assertEqual(headers["Content-Length"], "99990")
+        self.assertEqual(body, b"x" * 99990)
+
+    def test_memoryview(self):
+        import array
+        data = array.array("i", range(100))
+        self.client.post("messages", body=memoryview(data))
+        headers, body = self.received()
+        self.assertEqual(headers["Content-Length"], str(len(data.tobytes())))
+        self.assertEqual(body, data.tobytes())
+
+    def test_generator(self):
+        self.client.post("messages", body=(b"part%d" % i for i in range(3)))
+        headers, body = self.received()
+        self.assertEqual(headers.get("Transfer-Encoding"), "chunked")
+        self.assertFalse("Content-Length" in headers)
+        self.assertEqual(body, b"part0part1part2")
+
+    def test_multipart(self):
+        package = iron_core.MultipartEncoder([
+            ("data", '{"name": "worker"}'),
+            ("file", ("worker.zip", io.BytesIO(b"PK" * 5000),
+                      "application/zip"))
+        ], boundary="BOUNDARY")
+        self.client.post("codes", body=package)
+        headers, body = self.received()
+        self.assertEqual(headers["Content-Type"],
+                "multipart/form-data; boundary=BOUNDARY")
+        self.assertEqual(int(headers["Content-Length"]), len(body))
+        self.assertTrue(body.startswith(b'--BOUNDARY\r\nContent-Disposition: '
+                b'form-data; name="data"\r\n\r\n{"name": "worker"}\r\n'))
+        self.assertTrue(b'filename="worker.zip"\r\nContent-Type: '
+                b'application/zip\r\n\r\n' + b"PK" * 5000 in body)
+        self.assertTrue(body.endswith(b"\r\n--BOUNDARY--\r\n"))
+
+    def test_multipartBytesLike(self):
+        package = iron_core.MultipartEncoder([
+            ("array", bytearray(b"abc")),
+            ("view", ("view.bin", memoryview(b"xyz"),
+                      "application/octet-stream"))
+        ], boundary="BOUNDARY")
+        self.assertEqual(len(package.read()), len(package))
+        package.seek(0)
+        self.client.post("codes", body=package)
+        headers, body = self.received()
+        self.assertEqual(int(headers["Content-Length"]), len(body))
+        self.assertTrue(b'name="array"\r\n\r\nabc\r\n' in body)
+        self.assertTrue(b"application/octet-stream\r\n\r\nxyz\r\n" in body)
+
+    def test_fileRewoundOnRetry(self):
+        statuses = [503, 200]
+        self.server.responder = lambda handler: (statuses.pop(0), {}, b"")
+        with open("test_upload.bin", "wb") as f:
+            f.write(b"payload")
+        with open("test_upload.bin", "rb") as f:
+            self.client.post("messages", body=f,
+                    retry=iron_core.RetryPolicy(backoff=0))
+        self.assertEqual([r[3] for r in self.server.requests],
+                [b"payload", b"payload"])
+
+    def test_generatorNotRetried(self):
+        self.server.responder = lambda handler: (503, {}, b"")
+        self.assertRaises(requests.exceptions.HTTPError, self.client.post,
+                "messages", body=iter([b"once"]),
+                retry=iron_core.RetryPolicy(backoff=0))
+        self.assertEqual(len(self.server.requests), 1)
+
+
+class TestLazyImports(unittest.TestCase):
+    def test_import(self):
+        out = subprocess.check_output([sys.executable, "-c",
+                "import sys, iron_core; print(sorted(m for m in "
+                "('requests', 'dateutil') if m in sys.modules))"],
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(out.decode("ascii").strip(), "[]")
+
+    def test_rfc3339(self):
+        import dateutil.parser
+        for timestamp in ("2014-01-01T10:00:00.000000Z",
+                          "2014-01-01T11:00:00Z",
+                          "2020-05-06T07:08:09.1234567+05:30",
+                          "2020-05-06T07:08:09-0800",
+                          "2020-05-06 07:08:09",
+                          "May 6 2020"):
+            parsed = iron_core.IronClient.fromRfc3339(timestamp)
+            expected = dateutil.parser.parse(timestamp)
+            self.assertEqual(parsed, expected)
+            self.assertEqual(parsed.utcoffset(), expected.utcoffset())
+
+
+class TestJsonCodec(unittest.TestCase):
+    def setUp(self):
+        self.server = MockServer(lambda handler: (200,
+                {"Content-Type": "application/json; charset=utf-8"},
+                b'{"ids": ["1", "2"]}'))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_findJsonCodec(self):
+        self.assertEqual(iron_core.findJsonCodec("json").name, "json")
+        self.assertTrue(iron_core.findJsonCodec() is iron_core.findJsonCodec())
+        self.assertRaises(ValueError, iron_core.findJsonCodec, "yaml")
+        codec = iron_core.JsonCodec()
+        self.assertEqual(codec.loads(b'{"a": "\xc3\xa9"}'), {"a": u"\u00e9"})
+        self.assertEqual(codec.dumps([1]), b"[1]")
+
+    def test_customCodec(self):
+        calls = []
+
+        class Codec(iron_core.JsonCodec):
+            def loads(self, data):
+                calls.append(data)
+                return iron_core.JsonCodec.loads(self, data)
+
+        client = self.server.client(json_codec=Codec())
+        self.assertEqual(client.get("queues")["body"], {"ids": ["1", "2"]})
+        self.assertEqual(calls, [b'{"ids": ["1", "2"]}'])
+        client.close()
+
+    def test_rawBytes(self):
+        client = self.server.client()
+        result = client.get("queues", decode=False)
+        self.assertEqual(result["body"], b'{"ids": ["1", "2"]}')
+        self.assertEqual(result["content-type"], "application/json")
+        client.close()
+
+    def test_encodeBody(self):
+        client = self.server.client(json_codec="json")
+        client.post("queues/q/messages", body={"messages": [{"body": "hi"}]})
+        method, path, headers, body = self.server.requests[0]
+        self.assertEqual(headers["Content-Type"], "application/json")
+        self.assertEqual(json.loads(body.decode("utf-8")),
+                {"messages": [{"body": "hi"}]})
+        client.put("queues/q", body=[], headers={"content-type": "text/x"})
+        headers = self.server.requests[1][2]
+        self.assertEqual([v for k, v in headers.items()
+                          if k.lower() == "content-type"], ["text/x"])
+        client.close()
+
+    def test_invalidJsonFallsBackToText(self):
+        self.server.responder = lambda handler: (200,
+                {"Content-Type": "application/json"}, b"not json")
+        client = self.server.client()
+        self.assertEqual(client.get("queues")["body"], "not json")
+        client.close()
+
+
+class TestIronResponse(unittest.TestCase):
+    def setUp(self):
+        self.server = MockServer(lambda handler: (200,
+                {"Content-Type": "application/json", "X-Test": "yes"},
+                b'{"id": "1"}'))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_dictCompatible(self):
+        client = self.server.client()
+        result = client.get("queues")
+        self.assertEqual(sorted(result.keys()),
+                ["body", "content-type", "resp", "status"])
+        self.assertEqual(result["body"], {"id": "1"})
+        self.assertEqual(result["status"], 200)
+        self.assertEqual(result["content-type"], "application/json")
+        self.assertTrue(result["resp"] is result.resp)
+        self.assertEqual(result.get("missing"), None)
+        self.assertTrue("body" in result)
+        result["extra"] = 1
+        self.assertEqual(len(result), 5)
+        self.assertEqual(dict(result)["extra"], 1)
+        del result["extra"]
+        self.assertRaises(KeyError, result.__delitem__, "status")
+        result["body"] = "replaced"
+        self.assertEqual(result["body"], "replaced")
+        self.assertFalse(hasattr(result, "__dict__"))
+        client.close()
+
+    def test_lazyBody(self):
+        calls = []
+
+        class Codec(iron_core.JsonCodec):
+            def loads(self, data):
+                calls.append(data)
+                return iron_core.JsonCodec.loads(self, data)
+
+        client = self.server.client(json_codec=Codec())
+        result = client.get("queues")
+        self.assertEqual(calls, [])
+        self.assertEqual(result.body, {"id": "1"})
+        self.assertEqual(result.body, {"id": "1"})
+        self.assertEqual(len(calls), 1)
+        client.close()
+
+    def test_release(self):
+        client = self.server.client(keep_response=False)
+        result = client.get("queues")
+        self.assertTrue(result["resp"] is None)
+        self.assertEqual(result["body"], {"id": "1"})
+        self.assertEqual(result.headers["X-Test"], "yes")
+
+        result = self.server.client().get("queues")
+        del result["resp"]
+        self.assertTrue(result.resp is None)
+        self.assertEqual(result["body"], {"id": "1"})
+        client.close()
+
+
+@unittest.skipIf(iron_core_async is None, "aiohttp is not installed")
+class TestAsyncClient(unittest.TestCase):
+    def setUp(self):
+        self.server = MockServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def client(self, **kwargs):
+        return iron_core_async.AsyncIronClient(name="Test", version="0.1.0",
+                product="iron_worker", token="TEST", project_id="TEST2",
+                protocol="http", host="127.0.0.1",
+                port=self.server.server_address[1], **kwargs)
+
+    def runAll(self, client, *coros):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(asyncio.gather(*coros))
+        finally:
+            loop.run_until_complete(client.close())
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def test_concurrentRequests(self):
+        client = self.client()
+        results = self.runAll(client,
+                *[client.get("tasks/%d" % i) for i in range(20)])
+        self.assertEqual([r["body"] for r in results], [{"ok": True}] * 20)
+        self.assertEqual(results[0]["status"], 200)
+        self.assertEqual(results[0]["content-type"], "application/json")
+        self.assertEqual(len(self.server.requests), 20)
+        self.assertEqual(self.server.requests[0][2]["Authorization"],
+                "OAuth TEST")
+
+    def test_coalescing(self):
+        client = self.client(coalescer=True)
+        results = self.runAll(client,
+                *[client.get("tasks/1") for i in range(5)] +
+                [client.get("tasks/2")])
+        self.assertEqual([r["body"] for r in results], [{"ok": True}] * 6)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(client.coalescer.shared, 4)
+        self.assertEqual(client._inflight, {})
+
+    def test_responseCache(self):
+        client = self.client(response_cache=True)
+        results = []
+        for call in (lambda: client.get("tasks/1"),
+                     lambda: client.get("tasks/1"),
+                     lambda: client.delete("tasks/1"),
+                     lambda: client.get("tasks/1")):
+            results.append(self.runAll(client, call())[0]["body"])
+        self.assertEqual(results, [{"ok": True}] * 4)
+        self.assertEqual([r[0] for r in self.server.requests],
+                ["GET", "DELETE", "GET"])
+
+    def test_post(self):
+        client = self.client()
+        self.runAll(client, client.post("tasks", body='{"a": 1}'))
+        method, path, headers, body = self.server.requests[0]
+        self.assertEqual((method, path, body),
+                ("POST", "/2/projects/TEST2/tasks", b'{"a": 1}'))
+
+    def test_requestMany(self):
+        self.server.responder = lambda handler: (
+                404 if "missing" in handler.path else 200,
+                {"Content-Type": "application/json"}, b'{"ok": true}')
+        client = self.client()
+        results = self.runAll(client, client.request_many(
+                [("GET", "tasks/%d" % i) for i in range(6)] +
+                [("GET", "missing")], max_concurrency=2))[0]
+        self.assertEqual([r["body"] for r in results[:6]], [{"ok": True}] * 6)
+        self.assertTrue(isinstance(results[6],
+                iron_core_async.aiohttp.ClientResponseError))
+
+    def test_syncContextManager(self):
+        client = self.client()
+
+        def use():
+            with client:
+                pass
+        self.assertRaises(TypeError, use)
+
+    def test_uploads(self):
+        client = self.client()
+        package = iron_core.MultipartEncoder({"a": "b"}, boundary="BOUNDARY")
+        self.runAll(client,
+                client.post("tasks", body=(b"ab" for i in range(3))))
+        self.runAll(client, client.post("codes", body=package))
+        self.runAll(client, client.put("tasks/1", body=io.BytesIO(b"file")))
+        self.runAll(client, client.patch("tasks/1", body=bytearray(b"ab")))
+        requests = self.server.requests
+        self.assertEqual(requests[0][3], b"ababab")
+        self.assertEqual(requests[0][2].get("Transfer-Encoding"), "chunked")
+        self.assertEqual(requests[1][2]["Content-Type"],
+                "multipart/form-data; boundary=BOUNDARY")
+        self.assertEqual(int(requests[1][2]["Content-Length"]),
+                len(requests[1][3]))
+        self.assertTrue(requests[1][3].startswith(b"--BOUNDARY\r\n"))
+        self.assertEqual([r[3] for r in requests[2:]], [b"file", b"ab"])
+        self.assertEqual([r[2]["Content-Length"] for r in requests[2:]],
+                ["4", "2"])
+
+    def test_retryHooks(self):
+        statuses = [503, 200]
+        self.server.responder = lambda handler: (statuses.pop(0),
+                {"Content-Type": "application/json"}, b"{}")
+        client = self.client(retry_policy=iron_core.RetryPolicy(backoff=0))
+        events = []
+        client.addHook("after_response", lambda **info: events.append(info))
+        self.runAll(client, client.get("tasks"))
+        self.assertEqual([e["status"] for e in events], [503, 200])
+        self.assertTrue(all(0 <= e["server_time"] <= e["elapsed"]
+                            for e in events))
+        self.assertTrue(events[0]["response"].closed)
+
+
 def create_test_config(filename, content):
     file = open(filename, "w")
     file.write(json.dumps(content))